@@ -13,6 +13,7 @@ from matplotlib.backends.backend_qt5agg import FigureCanvas, NavigationToolbar2Q
 from matplotlib.backends.qt_compat import QtCore, QtWidgets
 from matplotlib.figure import Figure
 import additional_filter as add_filter
+import volume_cache
 
 try:
     from matplotlib.backend_bases import MouseButton
@@ -66,6 +67,13 @@ class IMIImageViewer(QtWidgets.QMainWindow):
         """
         return list(list(int(coord) for coord in m.pixel_position) for m in self.image_viewer.markers)
 
+    def get_image(self) -> sitk.Image:
+        """ Get the image of the viewer including all changes made by key-actions (e.g. opening or hole filling)
+
+        @return: the current image of the viewer
+        """
+        return self.image_viewer.image
+
     def init_menu_bar(self):
         """ Creates and populates the PyQt menuBar with viewer control actions
         """
@@ -93,7 +101,11 @@ class IMIImageViewer(QtWidgets.QMainWindow):
         save_view_action.setStatusTip('Save the currently displayed image slice as a PNG.')
         save_view_action.triggered.connect(self.save_current_view)
 
-        file_menu.addActions([open_action, open_mask_action, save_view_action, exit_action])
+        save_image_action = QAction('Save &Image', self)
+        save_image_action.setStatusTip('Save the current image including all changes made by key-actions.')
+        save_image_action.triggered.connect(self.save_image)
+
+        file_menu.addActions([open_action, open_mask_action, save_view_action, save_image_action, exit_action])
 
         view_menu = menubar.addMenu('&View')
         orientation_submenu = view_menu.addMenu('Image &Orientation')
@@ -176,7 +188,7 @@ class IMIImageViewer(QtWidgets.QMainWindow):
         if file_path != '':
             print('Loading image ' + file_path)
 
-            image = sitk.ReadImage(file_path)
+            image = volume_cache.read_image(file_path)
             self.image_viewer.set_image(image)
 
     def load_mask(self):
@@ -191,7 +203,7 @@ class IMIImageViewer(QtWidgets.QMainWindow):
         if file_path != '':
             print('Loading mask ' + file_path)
 
-            image = sitk.ReadImage(file_path)
+            image = volume_cache.read_image(file_path)
             mask = ImageMask(image, color='r')
             self.image_viewer.add_mask(mask)
 
@@ -207,6 +219,15 @@ class IMIImageViewer(QtWidgets.QMainWindow):
             print('Saving view to {}'.format(file_path))
             self.image_viewer.canvas.print_figure(filename=file_path, dpi=200, bbox_inches=0)
 
+    def save_image(self):
+        """ Choose a file to save the current image (e.g. a segmentation changed by key-actions) as nifti image.
+        """
+        file_path = self.file_dialog('Save Image', 'Image (*.nii.gz)', mode='save')
+
+        if file_path != '':
+            print('Saving image to {}'.format(file_path))
+            add_filter.save_segmentation(self.image_viewer.image, file_path)
+
 
 class ImageViewerWidget(QtWidgets.QWidget):
     """ PyQt Widget holding a matplotlib canvas to visualize and navigate through 3D image data
@@ -399,6 +420,16 @@ class ImageViewerWidget(QtWidgets.QWidget):
         self.image_array = sitk.GetArrayFromImage(self.image)
         self.redraw_slice()
 
+    def save_segmentation(self):
+        """ write self.image to segmentation.nii.gz
+
+        The filters of the key-actions only change the image in memory, the w key writes it to disk.
+        This functionality is only useful for the image "segmentation"!
+        """
+
+        add_filter.save_segmentation(self.image)
+        print('Saved image to segmentation.nii.gz')
+
     def change_orientation(self, orientation: Union[int, str]):
         """ Change the slicing dimension of the viewer.
         Orientation values are expected as in SLICE_ORIENTATION
@@ -608,9 +639,14 @@ class ImageViewerWidget(QtWidgets.QWidget):
 
         # draw each mask (no changes to canvas before canvas.draw() is called)
         for m in self.masks.keys():
-            self.masks[m] = add_mask_to_image(self.ax, m.get_slice(self.current_slice, self.orientation),
+            # empty slices are skipped, the others only draw the bounding box of the object
+            region = m.get_slice_region(self.current_slice, self.orientation)
+            if region is None:
+                self.masks[m] = None
+                continue
+            self.masks[m] = add_mask_to_image(self.ax, region[0],
                                               aspect=get_aspect_ratio_for_plane(m.get_spacing(), self.orientation),
-                                              alpha=m.alpha, color=m.color)
+                                              alpha=m.alpha, color=m.color, box=region[1])
 
     def clear_mask_plots(self):
         """ Remove all masks from the canvas.
@@ -775,6 +811,8 @@ class ImageViewerInteractor:
             self.iv.erode()
         elif event.key == 'd': # dilate the image
             self.iv.dilate()
+        elif event.key == 'w': # write the image to segmentation.nii.gz
+            self.iv.save_segmentation()
 
     def handle_mouse_button_down(self, event: mpl.backend_bases.MouseEvent):
         """ Handles mouse button down events by distributing event to
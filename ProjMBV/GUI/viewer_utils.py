@@ -1,4 +1,4 @@
-from typing import Tuple, Union, Sequence
+from typing import Optional, Tuple, Union, Sequence
 
 import SimpleITK as sitk
 import numpy as np
@@ -8,7 +8,11 @@ from matplotlib.image import AxesImage
 
 
 class ImageMask:
-    """ image mask container holding a mask image and display parameters """
+    """ image mask container holding a mask image and display parameters
+
+    Only the bounding box of the object is kept as uint8 array, together with an index of the non-empty slices
+    and their bounding boxes for every orientation, so that drawing a slice never touches the background.
+    """
     def __init__(self, binary_image: sitk.Image, alpha: float = 0.3, color: Union[str, Tuple[int]] = 'r'):
         """
 
@@ -17,18 +21,80 @@ class ImageMask:
         @param color: the desired color for the mask (all matplotlib's color definitions are possible)
         """
         self.mask_image = binary_image
-        self.mask_as_array = sitk.GetArrayFromImage(self.mask_image)
         self.alpha = alpha
         self.color = color
 
+        object_array = sitk.GetArrayViewFromImage(self.mask_image) != 0
+        self.shape = object_array.shape
+        # projections[axis] tells for the other two (numpy) axes, if there is object anywhere along axis
+        projections = [object_array.any(axis=axis) for axis in range(3)]
+        # for every orientation: the box (row start, row stop, column start, column stop) of every slice,
+        # all 0 for empty slices
+        self.slice_boxes = [self._slice_boxes(projections, orientation) for orientation in range(3)]
+        self.non_empty = [boxes[:, 1] > 0 for boxes in self.slice_boxes]
+
+        # bounding box of the whole object (numpy order), from the non-empty slices of each axis
+        self.offset = []
+        box = []
+        for axis in range(3):
+            slices = np.flatnonzero(self.non_empty[2 - axis])
+            start, stop = (int(slices[0]), int(slices[-1]) + 1) if len(slices) else (0, 0)
+            self.offset.append(start)
+            box.append(slice(start, stop))
+        self.cropped = np.ascontiguousarray(object_array[tuple(box)]).view(np.uint8)
+
+    @staticmethod
+    def _slice_boxes(projections: Sequence[np.ndarray], orientation: int) -> np.ndarray:
+        """ Computes the bounding box of every slice of an orientation from the projections of the object.
+
+        @param projections: object_array.any(axis) for every numpy axis
+        @param orientation: the slicing dimension
+        @return: int32 array with (row start, row stop, column start, column stop) per slice
+        """
+        axis = 2 - orientation  # sitk to numpy
+        rows_axis, columns_axis = (a for a in range(3) if a != axis)
+        boxes = []
+        # the rows of a slice are found in the projection along the columns and vice versa
+        for other_axis, projection in ((rows_axis, projections[columns_axis]), (columns_axis, projections[rows_axis])):
+            if other_axis < axis:
+                projection = projection.T
+            has_object = projection.any(axis=1)
+            start = projection.argmax(axis=1)
+            stop = projection.shape[1] - projection[:, ::-1].argmax(axis=1)
+            boxes += [np.where(has_object, start, 0), np.where(has_object, stop, 0)]
+        return np.stack(boxes, axis=1).astype(np.int32)
+
+    def get_slice_region(self, slice_index: int, orientation: int) -> Optional[Tuple[np.ndarray, Tuple[slice, slice]]]:
+        """ Get the bounding box of the object in a slice from the mask
+
+        @param slice_index: the index in the slicing dimension
+        @param orientation: the slicing dimension
+        @return: the uint8 part of the slice inside the box and the box (row and column slices in the slice),
+                 None if the slice does not contain any object
+        """
+        if not self.non_empty[orientation][slice_index]:
+            return None
+        row_start, row_stop, column_start, column_stop = (int(i) for i in self.slice_boxes[orientation][slice_index])
+        axis = 2 - orientation
+        rows_axis, columns_axis = (a for a in range(3) if a != axis)
+        index = [None] * 3
+        index[axis] = slice_index - self.offset[axis]
+        index[rows_axis] = slice(row_start - self.offset[rows_axis], row_stop - self.offset[rows_axis])
+        index[columns_axis] = slice(column_start - self.offset[columns_axis], column_stop - self.offset[columns_axis])
+        return self.cropped[tuple(index)], (slice(row_start, row_stop), slice(column_start, column_stop))
+
     def get_slice(self, slice_index: int, orientation: int) -> np.ndarray:
         """ Get a slice from the mask
 
         @param slice_index: the index in the slicing dimension
         @param orientation: the slicing dimension
-        @return: a slice from the dimension given in orientation at the given index
+        @return: a uint8 slice (1 for object) from the dimension given in orientation at the given index
         """
-        return self.mask_as_array[index_compatibility(get_3d_plane_index(slice_index, orientation))]
+        plane = np.zeros([n for axis, n in enumerate(self.shape) if axis != 2 - orientation], dtype=np.uint8)
+        region = self.get_slice_region(slice_index, orientation)
+        if region is not None:
+            plane[region[1]] = region[0]
+        return plane
 
     def get_spacing(self) -> Sequence[float]:
         """
@@ -133,7 +199,8 @@ def index_compatibility(index: Sequence[int]) -> Sequence[int]:
     return index[::-1]
 
 
-def add_mask_to_image(ax: Axes, mask: np.ndarray, aspect: float, alpha: float = 0.3, color: Union[str, Tuple[int]] = 'r') -> Union[AxesImage, None]:
+def add_mask_to_image(ax: Axes, mask: np.ndarray, aspect: float, alpha: float = 0.3, color: Union[str, Tuple[int]] = 'r',
+                      box: Tuple[slice, slice] = None) -> Union[AxesImage, None]:
     """ Add a single label mask an an alpha channel to the given axis.
     Any value in the mask not equal to 0 is considered as object, pixels with value 0 are considered as background.
 
@@ -143,13 +210,23 @@ def add_mask_to_image(ax: Axes, mask: np.ndarray, aspect: float, alpha: float =
     @param aspect: the aspect ratio of the axes
     @param alpha: the alpha value for the mask
     @param color: the color of the mask (use a string matplotlib.colors can interpret)
+    @param box: if given, mask is only the part of the slice inside this box (rows, columns), e.g. from
+                ImageMask.get_slice_region, and is drawn at its place in the slice
     @return: the AxesImage resulting from the plot call
     """
-    if mask.sum() == 0:
+    if not mask.any():
         return None
 
     cmap = ListedColormap([color])
     mask = np.ma.masked_where(mask == 0, mask)
-    plot = ax.matshow(mask, aspect=aspect, cmap=cmap, alpha=alpha)
+    if box is None:
+        return ax.matshow(mask, aspect=aspect, cmap=cmap, alpha=alpha)
+
+    # pixel centers are at integer coordinates, keep the view of the whole slice
+    limits = ax.get_xlim(), ax.get_ylim()
+    extent = (box[1].start - 0.5, box[1].stop - 0.5, box[0].stop - 0.5, box[0].start - 0.5)
+    plot = ax.matshow(mask, aspect=aspect, cmap=cmap, alpha=alpha, extent=extent)
+    ax.set_xlim(limits[0])
+    ax.set_ylim(limits[1])
 
     return plot
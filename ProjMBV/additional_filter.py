@@ -2,79 +2,310 @@ import SimpleITK as sitk
 import numpy as np
 import sys
 
-import image_viewing as vis
-from typing import List
+import morphology
+import thread_budget
+from morphology import FILL, FILL_SLICES, VOTING
+from profiling import profiled
+from roi import DIFFUSION_ITERATIONS, Box, bounding_box
+from typing import List, Optional, Sequence, Tuple, Union
 
 
-def normalise(image: sitk.Image) -> sitk.Image:
+# pixel types of the label maps from labeling
+LABEL_MAP_TYPES = (sitk.sitkLabelUInt8, sitk.sitkLabelUInt16, sitk.sitkLabelUInt32, sitk.sitkLabelUInt64)
+# integer images with a bigger range of values use np.percentile instead of a histogram
+HISTOGRAM_MAX_BINS = 1 << 24
+
+
+def percentiles(array: np.ndarray, qs: Sequence[float], ignore_background: bool = False) -> List[float]:
+    """ Computes several percentiles of an array in one pass.
+    Integer arrays are counted into one histogram (slice by slice, without copying the array), the percentiles are
+    read from its cumulative sum. The result is the same as np.percentile (linear interpolation) within
+    floating-point rounding.
+        Parameters:
+            array (np.ndarray): e.g. a view from sitk.GetArrayViewFromImage
+            qs (Sequence[float]): percentiles between 0 and 100
+            ignore_background (bool): leave out all voxels with the value 0
+        Returns: the percentiles in the order of qs
+    """
+
+    lowest, highest = int(array.min()), int(array.max())
+    if not np.issubdtype(array.dtype, np.integer) or highest - lowest >= HISTOGRAM_MAX_BINS:
+        values = array[array != 0] if ignore_background else array
+        return [float(p) for p in np.percentile(values, qs)]
+
+    histogram = np.zeros(highest - lowest + 1, dtype=np.intp)
+    for array_slice in array.reshape(-1, array.shape[-1]) if array.ndim < 3 else array:
+        # subtracted in intp, int8/int16 values would wrap around
+        histogram += np.bincount(np.subtract(array_slice.ravel(), lowest, dtype=np.intp), minlength=histogram.size)
+    if ignore_background and lowest <= 0 <= highest:
+        histogram[-lowest] = 0
+    return histogram_percentiles(histogram, lowest, qs)
+
+
+def histogram_percentiles(histogram: np.ndarray, lowest: int, qs: Sequence[float]) -> List[float]:
+    """ Reads percentiles from the histogram of an integer image (see percentiles).
+        Parameters:
+            histogram (np.ndarray): number of voxels of every value from lowest on
+            lowest (int): value of the first bin
+            qs (Sequence[float]): percentiles between 0 and 100
+        Returns: the percentiles in the order of qs
+    """
+
+    cumulative = np.cumsum(histogram)
+    n = int(cumulative[-1])
+    if n == 0:
+        return [np.nan] * len(qs)
+
+    results = []
+    for q in qs:
+        # virtual index and interpolation like np.percentile(..., method='linear')
+        q = np.true_divide(q, 100)
+        virtual_index = (n - 1) * q
+        previous_index = int(np.floor(virtual_index))
+        gamma = virtual_index - previous_index
+        previous_index = min(max(previous_index, 0), n - 1)
+        next_index = min(previous_index + 1, n - 1)
+        # value of the voxel with rank i in the sorted array
+        a, b = (float(lowest + np.searchsorted(cumulative, i, side='right')) for i in (previous_index, next_index))
+        results.append(float(b - (b - a) * (1 - gamma) if gamma >= 0.5 else a + (b - a) * gamma))
+    return results
+
+
+@profiled
+def normalise(image: sitk.Image, ignore_background: bool = False) -> sitk.Image:
     """ Normalises the image to (0, 500) and cuts of the edges.
     It will use the 5th and 99th percentile to cut of the edges.
     This method is only used by the segmentation pipeline.
         Parameters:
             image (sitk.Image): brain-MRT image
+            ignore_background (bool): compute the percentiles only over the voxels != 0
         Returns: normalised sitk.Image
     """
 
-    stat_filter = sitk.StatisticsImageFilter()
-    stat_filter.Execute(image)
+    # the view is only valid as long as image exists, which is the case until the end of this function
+    lower_percentile, upper_percentile = percentiles(sitk.GetArrayViewFromImage(image), (5, 99), ignore_background)
+    return intensity_window(image, lower_percentile, upper_percentile)
+
 
-    img_array = sitk.GetArrayFromImage(image)
-    lower_percentile = np.percentile(img_array, 5)
-    upper_percentile = np.percentile(img_array, 99)
+def intensity_window(image: sitk.Image, minimum: float, maximum: float) -> sitk.Image:
+    """ Maps the window (minimum, maximum) to (0, 500), everything outside of it is cut off.
+    This is the voxel-wise part of normalise, e.g. for slabs of an image with the percentiles of the whole image.
+        Parameters:
+            image (sitk.Image): brain-MRT image
+            minimum (float): lower end of the window, e.g. the 5th percentile
+            maximum (float): upper end of the window, e.g. the 99th percentile
+        Returns: normalised sitk.Image
+    """
 
-    window_filter = sitk.IntensityWindowingImageFilter()
+    window_filter = thread_budget.configure(sitk.IntensityWindowingImageFilter(), 'normalise')
     window_filter.SetOutputMaximum(500)
     window_filter.SetOutputMinimum(0)
-    window_filter.SetWindowMaximum(upper_percentile)
-    window_filter.SetWindowMinimum(lower_percentile)
+    window_filter.SetWindowMaximum(maximum)
+    window_filter.SetWindowMinimum(minimum)
     return window_filter.Execute(image)
 
 
-def gradient(image: sitk.Image) -> sitk.Image:
+# smoothing modes of gradient: the edge preserving anisotropic diffusion of the pipeline, or the faster curvature
+# flow and recursive Gaussian for batch runs, which trade some accuracy for speed
+ANISOTROPIC = 'anisotropic'
+CURVATURE = 'curvature'
+GAUSSIAN = 'gaussian'
+DIFFUSION_MODES = (ANISOTROPIC, CURVATURE, GAUSSIAN)
+DIFFUSION_TIME_STEP = 0.05
+
+
+def diffusion_sigma(iterations: int = DIFFUSION_ITERATIONS) -> float:
+    """ Gets the sigma (in voxels) of the Gaussian with the same diffusion time as the iterations.
+        Parameters:
+            iterations (int): number of diffusion iterations
+        Returns: sigma of the GAUSSIAN mode
+    """
+
+    return float(np.sqrt(2 * iterations * DIFFUSION_TIME_STEP))
+
+
+def diffusion_reach(iterations: int = DIFFUSION_ITERATIONS, mode: str = ANISOTROPIC, **_) -> int:
+    """ Gets how many voxels far gradient can look with these settings (4 sigma for the GAUSSIAN mode).
+        Parameters:
+            iterations (int): number of diffusion iterations
+            mode (str): one of DIFFUSION_MODES
+        Returns: reach in voxels
+    """
+
+    if mode == GAUSSIAN:
+        return int(np.ceil(4 * diffusion_sigma(iterations)))
+    return iterations
+
+
+@profiled
+def gradient(image: sitk.Image, iterations: int = DIFFUSION_ITERATIONS, tolerance: float = None,
+             threads: int = None, mode: str = ANISOTROPIC) -> sitk.Image:
     """ Executes a filter to smoothe the image while keeping the edges.
     This method is only used by the segmentation pipeline.
         Parameters:
             image (sitk.Image): brain-MRT image
+            iterations (int): maximum number of iterations
+            tolerance (float): if given, stop as soon as an iteration changes the voxels by less than this on average
+            threads (int): number of threads of the filter (default: from the thread budget, see thread_budget)
+            mode (str): one of DIFFUSION_MODES, GAUSSIAN smoothes once with the sigma of the same diffusion time
         Returns: smoothed sitk.Image
     """
 
-    grad_filter = sitk.GradientAnisotropicDiffusionImageFilter()  #schon etwas zeitintensiv
-    grad_filter.SetTimeStep(0.05)
-    return grad_filter.Execute(sitk.Cast(image, sitk.sitkFloat32))
+    if mode not in DIFFUSION_MODES:
+        raise ValueError('Unknown mode \'{}\'. Choose from {}.'.format(mode, DIFFUSION_MODES))
+    image = sitk.Cast(image, sitk.sitkFloat32)
+    if mode == GAUSSIAN:
+        grad_filter = sitk.SmoothingRecursiveGaussianImageFilter()
+        grad_filter.SetSigma(diffusion_sigma(iterations) * min(image.GetSpacing()))
+    elif mode == CURVATURE:
+        grad_filter = sitk.CurvatureFlowImageFilter()
+    else:
+        grad_filter = sitk.GradientAnisotropicDiffusionImageFilter()  #schon etwas zeitintensiv
+    thread_budget.configure(grad_filter, 'gradient')
+    if threads is not None:
+        grad_filter.SetNumberOfThreads(threads)
+    if mode == GAUSSIAN:
+        return grad_filter.Execute(image)
+
+    grad_filter.SetTimeStep(DIFFUSION_TIME_STEP)
+    if tolerance is None:
+        grad_filter.SetNumberOfIterations(iterations)
+        return grad_filter.Execute(image)
+    # one iteration at a time gives the same result (the anisotropic diffusion scales its conductance in every
+    # iteration anyway)
+    grad_filter.SetNumberOfIterations(1)
+    for _ in range(iterations):
+        smoothed_image = grad_filter.Execute(image)
+        change = np.abs(sitk.GetArrayViewFromImage(smoothed_image) - sitk.GetArrayViewFromImage(image)).mean()
+        image = smoothed_image
+        if change < tolerance:
+            break
+    return image
+
+
+def manual_seeds() -> bool:
+    """ Checks whether the seedpoints are set manually in the viewer (segmentation.py <case> --manually).
+        Returns: True, if seedpoints returns the markers of the viewer
+    """
+
+    return len(sys.argv) > 2 and sys.argv[2] == '--manually'
 
 
-def seedpoints(image: sitk.Image) -> List[List[int]]:
+@profiled
+def seedpoints(image: sitk.Image, cutoff: float = 495) -> Union[np.ndarray, List[List[int]]]:
     """ Gets seedpoints of the image.
-    It will use every pixel where the intensity is above 490.
+    It will use every pixel where the intensity is above the cutoff.
     This method is only used by the segmentation pipeline.
         Parameters:
             image (sitk.Image): brain-MRT image
-        Returns: List of indexes of seedpoints.
+            cutoff (float): minimum intensity of a seedpoint
+        Returns: int32 array with one index per row (the list of markers, if they are set manually).
     """
-    if len(sys.argv) > 2 and sys.argv[2] == '--manually':
+    if manual_seeds():
+        # the viewer (Qt, matplotlib) is only imported when it is needed, so batch runs stay headless
+        import image_viewing as vis
         return vis.show_and_return_markers(image, 'Set Seedpoints')
     else:
-        img_arr = np.array(sitk.GetArrayFromImage(image))
-        seeds = np.argwhere(img_arr > 495)
-        return seeds.tolist()
+        seeds = np.argwhere(sitk.GetArrayViewFromImage(image) > cutoff)
+        return seeds.astype(np.int32)
 
 
-def threshold(image: sitk.Image, seeds: List[List[int]]) -> sitk.Image:
-    """ Computes a threshold filter on the image with the borders (200, 500).
+@profiled
+def reduce_seeds(image: sitk.Image, seeds: Union[np.ndarray, List[List[int]]], cutoff: float = 495,
+                 lower: float = 490, upper: float = 500, max_seeds: int = None) -> np.ndarray:
+    """ Removes seedpoints which do not change the result of threshold.
+    Seedpoints outside of the image or outside of (lower, upper) grow nothing. All seedpoints in one connected
+    blob of voxels between max(cutoff, lower) and upper grow the same region, so only one of them is kept.
+    The seedpoints are used as sitk (x, y, z) indices, like threshold does.
+        Parameters:
+            image (sitk.Image): the image threshold is run on
+            seeds (np.ndarray or List[List[int]]): seedpoints from seedpoints
+            cutoff (float): intensity of the bright blobs, normally the cutoff of seedpoints
+            lower (float): lower border of threshold
+            upper (float): upper border of threshold
+            max_seeds (int): if given, at most this many evenly spaced seedpoints are kept
+                (this can change the result of threshold)
+        Returns: int32 array with one seedpoint per row
+    """
+
+    dimension = image.GetDimension()
+    seeds = np.asarray(seeds, dtype=np.int32).reshape(-1, dimension)
+    seeds = seeds[np.all((seeds >= 0) & (seeds < np.asarray(image.GetSize())), axis=1)]
+    # sitk (x, y, z) index to numpy [z, y, x]
+    index = tuple(seeds[:, ::-1].T)
+    values = sitk.GetArrayViewFromImage(image)[index]
+    in_range = (values >= lower) & (values <= upper)
+    seeds, index = seeds[in_range], tuple(i[in_range] for i in index)
+
+    # face connected like the region growing of threshold
+    blobs = sitk.ConnectedComponent(sitk.BinaryThreshold(image, max(cutoff, lower), upper), False)
+    labels = sitk.GetArrayViewFromImage(blobs)[index]
+    in_blob = labels != 0
+    _, first = np.unique(labels[in_blob], return_index=True)
+    seeds = np.concatenate([seeds[in_blob][np.sort(first)], seeds[~in_blob]])
+
+    if max_seeds is not None and len(seeds) > max_seeds:
+        seeds = seeds[np.linspace(0, len(seeds) - 1, max_seeds).astype(int)]
+    return seeds
+
+
+# engines of threshold
+FLOOD = 'flood'
+COMPONENTS = 'components'
+
+
+@profiled
+def threshold(image: sitk.Image, seeds: Union[np.ndarray, List[List[int]]], lower: float = 490,
+              upper: float = 500, engine: str = FLOOD) -> sitk.Image:
+    """ Computes a threshold filter on the image with the borders (lower, upper).
     This method is only used by the segmentation pipeline.
+    The FLOOD engine grows the regions from the seedpoints (sitk.ConnectedThresholdImageFilter), the COMPONENTS
+    engine labels all connected regions between lower and upper once and keeps the regions containing a seedpoint.
+    Both give the same mask, the time of COMPONENTS does not depend on the number of seedpoints.
         Parameters:
             image (sitk.Image): brain-MRT image
-            seeds (List[List[int]]): List of indices of the seedpoints
+            seeds (np.ndarray or List[List[int]]): indices of the seedpoints
+            lower (float): lower border, 490 for Flair and 470 for DWI
+            upper (float): upper border
+            engine (str): FLOOD or COMPONENTS
         Returns: thresholded sitk.Image
     """
 
-    thresh_filter = sitk.ConnectedThresholdImageFilter()
-    thresh_filter.SetSeedList(seeds)
-    thresh_filter.SetLower(490)
-    thresh_filter.SetUpper(500)
+    if engine == COMPONENTS:
+        return _threshold_components(image, seeds, lower, upper)
+    if engine != FLOOD:
+        raise ValueError('\'{}\' is not a valid engine. Choose \'{}\' or \'{}\' instead.'.format(engine, FLOOD,
+                                                                                                  COMPONENTS))
+
+    thresh_filter = thread_budget.configure(sitk.ConnectedThresholdImageFilter(), 'threshold')
+    thresh_filter.SetSeedList(np.asarray(seeds, dtype=np.int64).tolist())
+    thresh_filter.SetLower(lower)
+    thresh_filter.SetUpper(upper)
     return thresh_filter.Execute(image)
 
 
+def _threshold_components(image: sitk.Image, seeds: Union[np.ndarray, List[List[int]]], lower: float,
+                          upper: float) -> sitk.Image:
+    """ threshold with the COMPONENTS engine. """
+    component_filter = thread_budget.configure(sitk.ConnectedComponentImageFilter(), 'threshold')
+    # face connected like sitk.ConnectedThresholdImageFilter
+    component_filter.FullyConnectedOff()
+    labels = component_filter.Execute(sitk.BinaryThreshold(image, lower, upper))
+    label_array = sitk.GetArrayViewFromImage(labels)
+
+    # sitk (x, y, z) indices to numpy [z, y, x], seedpoints outside of the image are ignored like by sitk
+    seeds = np.asarray(seeds, dtype=np.int64).reshape(-1, image.GetDimension())
+    seeds = seeds[np.all((seeds >= 0) & (seeds < np.asarray(image.GetSize())), axis=1)]
+    keep = np.zeros(component_filter.GetObjectCount() + 1, dtype=np.uint8)
+    keep[label_array[tuple(seeds[:, ::-1].T)]] = 1
+    keep[0] = 0
+
+    result = sitk.GetImageFromArray(keep[label_array])
+    result.CopyInformation(image)
+    return result
+
+
+@profiled
 def labeling(image: sitk.Image) -> sitk.Image:
     """ Labels the image.
     This method is only used by the segmentation pipeline.
@@ -83,31 +314,73 @@ def labeling(image: sitk.Image) -> sitk.Image:
         Returns: labeled sitk.Image
     """
 
-    label_filter = sitk.BinaryImageToLabelMapFilter()
+    label_filter = thread_budget.configure(sitk.BinaryImageToLabelMapFilter(), 'labeling')
     label_filter.SetInputForegroundValue(1)
     return label_filter.Execute(image)
 
 
-def connected_component(image: sitk.Image) -> sitk.Image:
-    """ Searches for the biggest connected component in a labeled image.
-    This method is only used by the segmentation pipeline.
+@profiled
+def largest_components(image: sitk.Image, count: int = 1,
+                       minimum_size: int = 200) -> Tuple[Optional[sitk.Image], List[Tuple[int, Box]]]:
+    """ Selects the biggest connected components of a binary image.
+    The image is labeled once, the relabeling sorts the components by size, and the selected labels are turned
+    into a mask directly. Components as big as the smallest selected one are selected as well.
         Parameters:
-            image (sitk.Image): brain-MRT image
-        Returns: sitk.Image with biggest label
+            image (sitk.Image): binary image, every voxel != 0 is object (a label image or the label map from
+                labeling works as well)
+            count (int): number of components to select
+            minimum_size (int): minimum number of voxels of a selected component
+        Returns: uint8 mask of the selected components (None, if there is no component big enough)
+            and the size and bounding box (index, size in sitk order) of every selected component, biggest first
     """
 
-    relabel_filter = sitk.RelabelComponentImageFilter()
+    if image.GetPixelID() in LABEL_MAP_TYPES:
+        # the connected components filter only takes images, not label maps
+        image = sitk.LabelMapToLabel(image)
+    component_filter = thread_budget.configure(sitk.ConnectedComponentImageFilter(), 'connected_component')
+    component_filter.FullyConnectedOff()
+    relabel_filter = thread_budget.configure(sitk.RelabelComponentImageFilter(), 'connected_component')
     relabel_filter.SortByObjectSizeOn()
-    relabel_filter.Execute(image)
-    if 1 not in sitk.GetArrayFromImage(image):
-        return None
-    biggest_label = relabel_filter.GetSizeOfObjectsInPixels()[0]
-    if biggest_label < 200:      # keine Ahnung, was hier der beste Wert ist
-        return None
-    relabel_filter.SetMinimumObjectSize(biggest_label)
-    return relabel_filter.Execute(image)
+    labels = relabel_filter.Execute(component_filter.Execute(image))
+    sizes = relabel_filter.GetSizeOfObjectsInPixels()
+    if len(sizes) == 0 or sizes[0] < minimum_size:
+        return None, []
+
+    smallest = max(sizes[min(count, len(sizes)) - 1], minimum_size)
+    selected = sum(1 for size in sizes if size >= smallest)
+    # the selected labels are 1 to selected
+    label_array = sitk.GetArrayViewFromImage(labels)
+    if selected == 1:
+        mask_array = (label_array == 1).view(np.uint8)
+    else:
+        mask_array = ((label_array != 0) & (label_array <= selected)).view(np.uint8)
+
+    components = []
+    for label in range(1, selected + 1):
+        # numpy (z, y, x) slices to sitk (x, y, z) index and size
+        box = bounding_box(mask_array if selected == 1 else label_array == label)[::-1]
+        components.append((sizes[label - 1], (tuple(s.start for s in box), tuple(s.stop - s.start for s in box))))
+
+    mask = sitk.GetImageFromArray(mask_array)
+    mask.CopyInformation(image)
+    return mask, components
 
 
+@profiled
+def connected_component(image: sitk.Image, minimum_size: int = 200) -> Optional[sitk.Image]:
+    """ Searches for the biggest connected component in a binary or labeled image.
+    This method is only used by the segmentation pipeline.
+        Parameters:
+            image (sitk.Image): binary image (or the label map from labeling, see largest_components)
+            minimum_size (int): minimum number of voxels of the biggest component
+        Returns: uint8 sitk.Image with the biggest component, None if there is none or it is smaller than minimum_size
+    """
+
+    # keine Ahnung, was für minimum_size der beste Wert ist
+    return largest_components(image, 1, minimum_size)[0]
+
+
+@profiled
 def opening(image: sitk.Image) -> sitk.Image:
     """ Performs an opening on a binary image.
     This method is accessible through pressing the o key and is used by the segmentation pipeline.
@@ -116,46 +389,56 @@ def opening(image: sitk.Image) -> sitk.Image:
         Returns: sitk.Image after opening
     """
 
-    open_filter = sitk.BinaryMorphologicalOpeningImageFilter()
+    open_filter = thread_budget.configure(sitk.BinaryMorphologicalOpeningImageFilter(), 'opening')
     #open_filter.SetKernelRadius((3,3,3))
     open_image = open_filter.Execute(image)
-    sitk.WriteImage(open_image, 'segmentation.nii.gz')
     return open_image
 
 
-def closing(image: sitk.Image) -> sitk.Image:
+@profiled
+def closing(image: sitk.Image, radius: Union[int, Sequence[int]] = (2,2,2)) -> sitk.Image:
     """ Performs a closing on a binary image.
     This method is accessible through pressing the c key and is used by the segmentation pipeline.
         Parameters:
             image (sitk.Image): brain-MRT image
+            radius (int or Sequence[int]): kernel radius
         Returns: sitk.Image after closing
     """
 
-    close_filter = sitk.BinaryMorphologicalClosingImageFilter()
-    close_filter.SetKernelRadius((2,2,2))
+    close_filter = thread_budget.configure(sitk.BinaryMorphologicalClosingImageFilter(), 'closing')
+    close_filter.SetKernelRadius(radius)
     close_image = close_filter.Execute(image)
-    sitk.WriteImage(close_image, 'segmentation.nii.gz')
     return close_image
 
 
-def hole_filling(image: sitk.Image) -> sitk.Image:
+@profiled
+def hole_filling(image: sitk.Image, radius: int = 2, iterations: int = 20, engine: str = VOTING,
+                 convergence: List[int] = None) -> sitk.Image:
     """ Filling holes in a binary image.
     This method is accessible through pressing the f key and is used by the segmentation pipeline.
+    The voting gives the same result as sitk.VotingBinaryIterativeHoleFillingImageFilter, but only runs around the
+    foreground (see morphology.fused_morphology). FILL and FILL_SLICES fill every hole in one pass first,
+    the voting only smoothes the border afterwards (iterations 0 for no smoothing).
         Parameters:
             image (sitk.Image): brain-MRT image
+            radius (int): radius of the voting neighbourhood
+            iterations (int): maximum number of iterations
+            engine (str): VOTING, FILL (holes in 3D) or FILL_SLICES (holes in every axial slice)
+            convergence (List[int]): if given, the number of changed voxels of every voting iteration is appended
         Returns: sitk.Image with less or smaller holes
     """
 
-    hole_filter = sitk.VotingBinaryIterativeHoleFillingImageFilter()
-    hole_filter.SetForegroundValue(1)
-    hole_filter.SetBackgroundValue(0)
-    hole_filter.SetRadius(2)
-    hole_filter.SetMaximumNumberOfIterations(20)
-    hole_image = hole_filter.Execute(image)
-    sitk.WriteImage(hole_image, 'segmentation.nii.gz')
+    changes = []
+    hole_image = morphology.fused_morphology(
+        image, [('hole_filling', {'radius': radius, 'iterations': iterations, 'engine': engine})], changes)
+    if convergence is not None:
+        convergence.extend(changes[0] if changes else [])
+    if hole_image.GetPixelID() != image.GetPixelID():
+        hole_image = sitk.Cast(hole_image, image.GetPixelID())
     return hole_image
 
 
+@profiled
 def dilate(image:sitk.Image) -> sitk.Image:
     """ Dilate a binary image.
     This method is accessible through pressing the d key and is used by the segmentation pipeline.
@@ -164,13 +447,13 @@ def dilate(image:sitk.Image) -> sitk.Image:
         Returns: dilated sitk.Image
     """
 
-    dilate_filter = sitk.BinaryDilateImageFilter()
+    dilate_filter = thread_budget.configure(sitk.BinaryDilateImageFilter(), 'dilate')
     #dilate_filter.SetKernelRadius((2,2,2))
     dilate_image = dilate_filter.Execute(image)
-    sitk.WriteImage(dilate_image, 'segmentation.nii.gz')
     return dilate_image
 
 
+@profiled
 def erode(image:sitk.Image) -> sitk.Image:
     """ Erode a binary image.
     This method is only accessible through pressing the e key.
@@ -179,7 +462,19 @@ def erode(image:sitk.Image) -> sitk.Image:
         Returns: eroded sitk.Image
     """
 
-    erode_filter = sitk.BinaryErodeImageFilter()
+    erode_filter = thread_budget.configure(sitk.BinaryErodeImageFilter(), 'erode')
     erode_image = erode_filter.Execute(image)
-    sitk.WriteImage(erode_image, 'segmentation.nii.gz')
-    return erode_image
\ No newline at end of file
+    return erode_image
+
+
+@profiled
+def save_segmentation(image: sitk.Image, path: str = 'segmentation.nii.gz'):
+    """ Writes a segmentation to disk.
+    The filters above only return their result, so this is the only place where a segmentation is persisted.
+    It is used at the end of the segmentation pipeline and by the w key of the viewer.
+        Parameters:
+            image (sitk.Image): segmentation
+            path (str): output path
+    """
+
+    sitk.WriteImage(image, path)
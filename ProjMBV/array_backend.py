@@ -0,0 +1,357 @@
+import functools
+import importlib.util
+import json
+import os
+import platform
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import SimpleITK as sitk
+import numpy as np
+
+import additional_filter as filter
+import morphology
+
+# SITK runs the function of additional_filter on an image built from the array,
+# NUMPY runs the array version below without any sitk.Image
+SITK = 'sitk'
+NUMPY = 'numpy'
+BACKENDS = (SITK, NUMPY)
+# AUTO chooses the faster backend of every operation by a micro-benchmark
+AUTO = 'auto'
+CHOICES = (AUTO, SITK, NUMPY)
+
+# MBV_BACKEND=sitk or MBV_BACKEND=numpy forces a backend, if no other choice is passed (see backend)
+FORCED = os.environ.get('MBV_BACKEND', AUTO)
+# hole_filling of additional_filter already runs the fused voting of morphology on the array, both backends only
+# differ by the conversions, so it is not benchmarked and AUTO always runs it on the array
+CONVERSION_ONLY = ('hole_filling',)
+# the benchmark results are stored per machine, so that every process does not measure again
+TABLE_PATH = os.environ.get('MBV_BACKEND_TABLE', '.backend_table.json')
+# edge lengths of the cubes the micro-benchmark runs on
+BENCHMARK_SIDES = (32, 64, 128)
+
+
+def normalise(array: np.ndarray, ignore_background: bool = False) -> np.ndarray:
+    """ additional_filter.normalise on an array, the result is exactly the same as sitk.IntensityWindowing.
+        Parameters:
+            array (np.ndarray): brain-MRT image
+            ignore_background (bool): compute the percentiles only over the voxels != 0
+        Returns: array of the same type normalised to (0, 500)
+    """
+
+    lower, upper = filter.percentiles(array, (5, 99), ignore_background)
+    # the window has the pixel type of the image in itk, so integer images cut the percentiles off
+    lower, upper = (float(np.asarray(value).astype(array.dtype)) for value in (lower, upper))
+    scale = 500.0 / (upper - lower)
+    result = array.astype(np.float64)
+    result *= scale
+    result -= lower * scale
+    result[array < lower] = 0
+    result[array > upper] = 500
+    return result.astype(array.dtype)
+
+
+def seedpoints(array: np.ndarray, cutoff: float = 495) -> np.ndarray:
+    """ additional_filter.seedpoints on an array (without the manual mode).
+        Parameters:
+            array (np.ndarray): smoothed brain-MRT image
+            cutoff (float): minimum intensity of a seedpoint
+        Returns: int32 array with one index per row
+    """
+
+    return np.argwhere(array > cutoff).astype(np.int32)
+
+
+def threshold(array: np.ndarray, seeds: Union[np.ndarray, List[List[int]]], lower: float = 490,
+              upper: float = 500) -> np.ndarray:
+    """ additional_filter.threshold on an array, labels the regions between lower and upper like its COMPONENTS
+    engine (needs scipy).
+        Parameters:
+            array (np.ndarray): smoothed brain-MRT image
+            seeds (np.ndarray or List[List[int]]): indices of the seedpoints, in sitk (x, y, z) order like for sitk
+            lower (float): lower border
+            upper (float): upper border
+        Returns: uint8 array with the regions containing a seedpoint
+    """
+
+    from scipy import ndimage  # optional, imported on the first use (see numpy_operations)
+    labels, count = ndimage.label((array >= lower) & (array <= upper))
+    # sitk (x, y, z) indices to numpy [z, y, x], seedpoints outside of the image are ignored like by sitk
+    seeds = np.asarray(seeds, dtype=np.int64).reshape(-1, array.ndim)[:, ::-1]
+    seeds = seeds[np.all((seeds >= 0) & (seeds < np.asarray(array.shape)), axis=1)]
+    keep = np.zeros(count + 1, dtype=np.uint8)
+    keep[labels[tuple(seeds.T)]] = 1
+    keep[0] = 0
+    return keep[labels]
+
+
+def connected_component(array: np.ndarray, minimum_size: int = 200) -> Optional[np.ndarray]:
+    """ additional_filter.connected_component on an array (needs scipy).
+        Parameters:
+            array (np.ndarray): binary array
+            minimum_size (int): minimum number of voxels of the biggest component
+        Returns: uint8 array with the biggest component (all of them, if several are as big),
+            None if there is none or it is smaller than minimum_size
+    """
+
+    from scipy import ndimage  # optional, imported on the first use (see numpy_operations)
+    labels, count = ndimage.label(array != 0)
+    if count == 0:
+        return None
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    biggest = sizes.max()
+    if biggest < minimum_size:
+        return None
+    return (sizes == biggest).astype(np.uint8)[labels]
+
+
+def _morphology(name: str) -> Callable:
+    """ Array version of a binary morphology filter of additional_filter (see morphology.fused_morphology). """
+    def run(array: np.ndarray, **params) -> np.ndarray:
+        return morphology.fused_morphology_array(array, [(name, params)])
+    return run
+
+
+@functools.lru_cache(maxsize=None)
+def numpy_operations() -> Dict[str, Callable]:
+    """ Gets the array versions of the operations of additional_filter.
+    threshold and connected_component need scipy, which is only looked up here and imported on their first call,
+    so importing this module stays as cheap as SimpleITK and numpy.
+        Returns: function of every operation with an array version
+    """
+
+    operations = {'normalise': normalise, 'seedpoints': seedpoints}
+    operations.update((name, _morphology(name)) for name in morphology.STEPS)
+    if importlib.util.find_spec('scipy') is not None:
+        operations.update(threshold=threshold, connected_component=connected_component)
+    return operations
+
+
+def run_sitk(operation: str, array: np.ndarray, *args, **params):
+    """ Runs an operation of additional_filter on an array, the result is converted back into an array.
+        Parameters:
+            operation (str): name of the function in additional_filter
+            array (np.ndarray): input in numpy (z, y, x) order
+            args, params: further arguments of the function
+        Returns: the result as array (seedpoints as they are, None stays None)
+    """
+
+    result = getattr(filter, operation)(sitk.GetImageFromArray(array), *args, **params)
+    return sitk.GetArrayFromImage(result) if isinstance(result, sitk.Image) else result
+
+
+def _benchmark_inputs(side: int) -> Dict[str, Tuple]:
+    """ Builds the inputs of every operation on a cube: a smooth image with bright blobs and its mask. """
+    rng = np.random.default_rng(0)
+    noise = sitk.GetImageFromArray(rng.random((side,) * 3, dtype=np.float32))
+    smooth = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(noise, 2.0))
+    smooth = (smooth - smooth.min()) / (smooth.max() - smooth.min()) * 500
+    image = (smooth * 4).astype(np.int16)
+    mask = (smooth > 300).astype(np.uint8)
+    seeds = seedpoints(smooth, 495)[:, ::-1]
+    return {'normalise': (image,), 'seedpoints': (smooth,), 'threshold': (smooth, seeds, 300, 500),
+            'connected_component': (mask, 0), 'opening': (mask,), 'closing': (mask,), 'dilate': (mask,),
+            'erode': (mask,)}
+
+
+def _machine() -> str:
+    return '{} {} cores, SimpleITK {}, numpy {}'.format(platform.processor() or platform.machine(), os.cpu_count(),
+                                                        sitk.Version_VersionString(), np.__version__)
+
+
+class BackendSelector:
+    """ Chooses the faster backend of every operation for the size of its input.
+
+    The micro-benchmark runs every operation with both backends on cubes of BENCHMARK_SIDES (including the
+    conversions between sitk.Image and numpy, which the NUMPY backend saves), inputs of other sizes use the
+    result of the closest cube.
+    """
+
+    def __init__(self, table: Dict[str, List[Tuple[int, str]]] = None):
+        """
+        @param table: for every operation a list of (voxels, faster backend), e.g. from benchmark or load
+        """
+        self.table = table or {}
+
+    def benchmark(self, sides: Tuple[int, ...] = BENCHMARK_SIDES, repeats: int = 3) -> Dict[str, List[Tuple]]:
+        """ Measures both backends of every operation (the best of some runs each).
+
+        @param sides: edge lengths of the cubes
+        @param repeats: runs per operation, backend and size
+        @return: for every operation a list of (voxels, time with SITK, time with NUMPY) in seconds
+        """
+        timings = {}
+        for side in sides:
+            for operation, args in _benchmark_inputs(side).items():
+                if operation not in numpy_operations():
+                    continue
+                times = []
+                for call in (lambda: run_sitk(operation, *args), lambda: numpy_operations()[operation](*args)):
+                    best = np.inf
+                    for _ in range(repeats):
+                        start = time.perf_counter()
+                        call()
+                        best = min(best, time.perf_counter() - start)
+                    times.append(best)
+                timings.setdefault(operation, []).append((side ** 3,) + tuple(times))
+        self.table = {operation: [(voxels, SITK if sitk_time <= numpy_time else NUMPY)
+                                  for voxels, sitk_time, numpy_time in rows] for operation, rows in timings.items()}
+        return timings
+
+    def choose(self, operation: str, voxels: int) -> str:
+        """ Gets the faster backend of an operation.
+
+        @param operation: name of the operation
+        @param voxels: number of voxels of the input
+        @return: SITK or NUMPY
+        """
+        rows = self.table.get(operation)
+        if not rows:
+            return SITK
+        return min(rows, key=lambda row: abs(np.log(voxels) - np.log(row[0])))[1]
+
+    def save(self, path: str = TABLE_PATH):
+        """ Stores the table together with a description of the machine. """
+        with open(path, 'w') as table_file:
+            json.dump({'machine': _machine(), 'table': self.table}, table_file)
+
+    @classmethod
+    def load(cls, path: str = TABLE_PATH) -> Optional['BackendSelector']:
+        """ Loads a table, if it has been measured on the same machine.
+
+        @param path: path of the stored table
+        @return: the selector or None
+        """
+        try:
+            with open(path) as table_file:
+                stored = json.load(table_file)
+        except (OSError, ValueError):
+            return None
+        if stored.get('machine') != _machine():
+            return None
+        return cls({operation: [tuple(row) for row in rows] for operation, rows in stored['table'].items()})
+
+
+_selector = None  # type: Optional[BackendSelector]
+
+
+def selector() -> BackendSelector:
+    """ Gets the selector of this process, the micro-benchmark only runs if there is no stored table yet.
+        Returns: the selector
+    """
+
+    global _selector
+    if _selector is None:
+        _selector = BackendSelector.load()
+        if _selector is None:
+            _selector = BackendSelector()
+            _selector.benchmark()
+            try:
+                _selector.save()
+            except OSError:  # e.g. read-only directory, the next process measures again
+                pass
+    return _selector
+
+
+def backend(operation: str, voxels: int, choice: str = None) -> str:
+    """ Gets the backend an operation runs with (the given one, or the faster one on this machine).
+        Parameters:
+            operation (str): name of the function in additional_filter
+            voxels (int): number of voxels of the input
+            choice (str): AUTO, SITK or NUMPY (default: MBV_BACKEND)
+        Returns: SITK or NUMPY
+    """
+
+    choice = choice or FORCED
+    if choice not in CHOICES:
+        raise ValueError('Unknown backend \'{}\'. Choose from {}.'.format(choice, CHOICES))
+    if operation not in numpy_operations() or choice == SITK:
+        return SITK
+    if choice == NUMPY or operation in CONVERSION_ONLY:
+        return NUMPY
+    return selector().choose(operation, voxels)
+
+
+def run(operation: str, array: np.ndarray, *args, choice: str = None, **params):
+    """ Runs an operation of additional_filter on an array with the faster backend.
+        Parameters:
+            operation (str): name of the function in additional_filter
+            array (np.ndarray): input in numpy (z, y, x) order
+            args, params: further arguments of the function
+            choice (str): AUTO, SITK or NUMPY (see backend)
+        Returns: the result as array (None stays None)
+    """
+
+    if backend(operation, array.size, choice) == NUMPY:
+        return numpy_operations()[operation](array, *args, **params)
+    return run_sitk(operation, array, *args, **params)
+
+
+def run_morphology(array: np.ndarray, steps: List[morphology.Step], choice: str = None) -> np.ndarray:
+    """ Runs a chain of binary morphology filters, every step with its own backend (see backend).
+    Consecutive steps on NUMPY run as one fused chain, the others as the filters of additional_filter.
+        Parameters:
+            array (np.ndarray): binary array (0 and 1)
+            steps (List[morphology.Step]): see morphology.fused_morphology
+            choice (str): AUTO, SITK or NUMPY (see backend)
+        Returns: uint8 array after the last step
+    """
+
+    fused = []
+    for name, params in steps:
+        if backend(name, array.size, choice) == NUMPY:
+            fused.append((name, params))
+            continue
+        if fused:
+            array, fused = morphology.fused_morphology_array(array, fused), []
+        array = run_sitk(name, array, **params)
+    return morphology.fused_morphology_array(array, fused) if fused else array
+
+
+def segment(array: np.ndarray, parameters: Dict, spacing: Tuple[float, ...] = None,
+            diffusion: Dict = None, choice: str = None) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """ Runs the segmentation chain of pipeline.segment on an array, every operation with the faster backend.
+    Only the smoothing always needs a sitk.Image.
+        Parameters:
+            array (np.ndarray): brain-MRT image in numpy (z, y, x) order
+            parameters (Dict): parameters like pipeline.FLAIR_PARAMETERS
+            spacing (Tuple[float, ...]): spacing in sitk (x, y, z) order, only used by the smoothing
+            diffusion (Dict): parameters of filter.gradient
+            choice (str): AUTO, SITK or NUMPY for every operation (see backend)
+        Returns: the normalised array and the segmentation (None, if no lesion big enough was found)
+    """
+
+    normalised = run('normalise', array, choice=choice)
+    image = sitk.GetImageFromArray(normalised)
+    if spacing is not None:
+        image.SetSpacing(spacing)
+    smoothed = sitk.GetArrayFromImage(filter.gradient(image, **(diffusion or {})))
+    del image
+
+    # the seedpoints are used in sitk (x, y, z) order like in the pipeline
+    seeds = run('seedpoints', smoothed, parameters['seed_cutoff'], choice=choice)
+    if backend('threshold', smoothed.size, choice) == SITK:
+        # the region growing of sitk takes longer with every seedpoint (see pipeline.region_growing)
+        seeds = filter.reduce_seeds(sitk.GetImageFromArray(smoothed), seeds, parameters['seed_cutoff'],
+                                    parameters['lower'], parameters['upper'])
+    mask = run('threshold', smoothed, seeds, parameters['lower'], parameters['upper'], choice=choice)
+    del smoothed
+
+    steps = [('opening', {}), ('closing', {'radius': parameters['closing_radius']})]
+    if parameters['dilate']:
+        steps.append(('dilate', {}))
+    steps.append(('hole_filling', {'radius': parameters['hole_radius'], 'iterations': parameters['hole_iterations'],
+                                   'engine': parameters.get('hole_engine', filter.VOTING)}))
+    mask = run_morphology(mask, steps, choice)
+    return normalised, run('connected_component', mask, parameters['minimum_size'], choice=choice)
+
+
+if __name__ == '__main__':
+    timings = BackendSelector().benchmark()
+    print(_machine())
+    for operation, rows in timings.items():
+        for voxels, sitk_time, numpy_time in rows:
+            print('{:<20} {:>9} voxels  sitk {:8.4f} s  numpy {:8.4f} s  -> {}'.format(
+                operation, voxels, sitk_time, numpy_time, SITK if sitk_time <= numpy_time else NUMPY))
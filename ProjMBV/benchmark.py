@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Sequence
+
+import SimpleITK as sitk
+import additional_filter as filter
+import morphology
+import pipeline
+from profiling import resident_memory
+
+# stages in the order of the Flair chain, each one gets the results of the stages before
+STAGES = ['normalise', 'gradient', 'gradient_curvature', 'gradient_gaussian', 'seedpoints', 'reduce_seeds',
+          'threshold', 'threshold_components', 'opening', 'closing', 'dilate', 'hole_filling', 'hole_filling_fill',
+          'hole_filling_fill_slices', 'fused_morphology', 'labeling', 'connected_component']
+# the morphology of the Flair chain with the default parameters of the filters
+MORPHOLOGY_STEPS = [('opening', {}), ('closing', {}), ('dilate', {}), ('hole_filling', {})]
+
+
+class PeakMemory:
+    """ Measures the peak resident memory of the process while the with-block runs.
+    The memory is sampled by a thread, because SimpleITK allocates outside of Python.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+        @param interval: sampling interval in seconds
+        """
+        self.interval = interval
+        self.start = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, resident_memory())
+
+    def __enter__(self):
+        self.start = self.peak = resident_memory()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, resident_memory())
+
+    @property
+    def delta(self) -> int:
+        """
+        @return: peak memory above the memory at the start of the block in bytes
+        """
+        return self.peak - self.start
+
+
+def stage_calls(image: sitk.Image) -> Dict[str, Callable]:
+    """ Runs the Flair chain once and builds a call without arguments for every stage from its inputs.
+        Parameters:
+            image (sitk.Image): Flair brain-MRT image
+        Returns: dict with a callable for every stage in STAGES
+    """
+
+    normalised = filter.normalise(image)
+    grad = filter.gradient(normalised)
+    all_seeds = filter.seedpoints(grad)
+    seeds = filter.reduce_seeds(grad, all_seeds)
+    thresh = filter.threshold(grad, seeds)
+    opened = filter.opening(thresh)
+    closed = filter.closing(opened)
+    dilated = filter.dilate(closed)
+    holes = filter.hole_filling(dilated)
+    return {
+        'normalise': lambda: filter.normalise(image),
+        'gradient': lambda: filter.gradient(normalised),
+        # the faster smoothing modes for batch runs
+        'gradient_curvature': lambda: filter.gradient(normalised, mode=filter.CURVATURE),
+        'gradient_gaussian': lambda: filter.gradient(normalised, mode=filter.GAUSSIAN),
+        'seedpoints': lambda: filter.seedpoints(grad),
+        'reduce_seeds': lambda: filter.reduce_seeds(grad, all_seeds),
+        'threshold': lambda: filter.threshold(grad, seeds),
+        # the alternative engine, with all seedpoints (it does not need reduce_seeds)
+        'threshold_components': lambda: filter.threshold(grad, all_seeds, engine=filter.COMPONENTS),
+        'opening': lambda: filter.opening(thresh),
+        'closing': lambda: filter.closing(opened),
+        'dilate': lambda: filter.dilate(closed),
+        'hole_filling': lambda: filter.hole_filling(dilated),
+        # the exact fills without smoothing
+        'hole_filling_fill': lambda: filter.hole_filling(dilated, iterations=0, engine=filter.FILL),
+        'hole_filling_fill_slices': lambda: filter.hole_filling(dilated, iterations=0, engine=filter.FILL_SLICES),
+        # opening, closing, dilate and hole_filling as one operation
+        'fused_morphology': lambda: morphology.fused_morphology(thresh, MORPHOLOGY_STEPS),
+        'labeling': lambda: filter.labeling(holes),
+        'connected_component': lambda: filter.connected_component(holes),
+    }
+
+
+def measure(call: Callable, repeats: int) -> Dict[str, List[float]]:
+    """ Runs a call several times and measures each run.
+        Parameters:
+            call (Callable): call without arguments
+            repeats (int): number of runs
+        Returns: dict with lists of the wall times (s), cpu times (s) and peak memory (bytes) of each run
+    """
+
+    results = {'wall': [], 'cpu': [], 'memory': []}
+    for _ in range(repeats):
+        with PeakMemory() as memory:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            result = call()
+            results['wall'].append(time.perf_counter() - wall_start)
+            results['cpu'].append(time.process_time() - cpu_start)
+        results['memory'].append(memory.delta)
+        del result
+    return results
+
+
+def run_benchmark(case_ids: Sequence[str], stages: Sequence[str] = STAGES, repeats: int = 3,
+                  data_dir: str = pipeline.DATA_DIR) -> Dict:
+    """ Benchmarks the stages on every case.
+        Parameters:
+            case_ids (Sequence[str]): cases to use
+            stages (Sequence[str]): stages to measure
+            repeats (int): runs per stage and case
+            data_dir (str): directory containing the case directories
+        Returns: the report (see write_report)
+    """
+
+    report = {
+        'meta': {'python': platform.python_version(), 'simpleitk': sitk.Version.VersionString(),
+                 'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeats': repeats},
+        'cases': {},
+    }
+    for case_id in case_ids:
+        print('benchmarking case', case_id, file=sys.stderr)
+        calls = stage_calls(sitk.ReadImage(pipeline.case_path(case_id, pipeline.FLAIR, data_dir)))
+        report['cases'][case_id] = {stage: measure(calls[stage], repeats) for stage in stages}
+    return report
+
+
+def summarise(report: Dict) -> Dict[str, float]:
+    """ Sums the median wall time of every stage over all cases.
+        Parameters:
+            report (Dict): report from run_benchmark
+        Returns: dict with the total median wall time of every stage in seconds
+    """
+
+    totals = {}
+    for case in report['cases'].values():
+        for stage, results in case.items():
+            totals[stage] = totals.get(stage, 0) + statistics.median(results['wall'])
+    return totals
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float = 0.1) -> List[str]:
+    """ Compares a report with a saved baseline and prints the change of every stage.
+    Only cases and stages contained in both reports are compared.
+        Parameters:
+            report (Dict): report from run_benchmark
+            baseline (Dict): saved report
+            tolerance (float): relative slow down which still is no regression
+        Returns: names of the stages which got slower than the tolerance
+    """
+
+    common_cases = set(report['cases']) & set(baseline['cases'])
+    current = summarise({'cases': {c: report['cases'][c] for c in common_cases}})
+    before = summarise({'cases': {c: baseline['cases'][c] for c in common_cases}})
+
+    regressions = []
+    for stage in STAGES:
+        if stage not in current or stage not in before:
+            continue
+        ratio = current[stage] / before[stage] if before[stage] > 0 else 1.0
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(stage)
+        print('{:<20} {:>9.3f} s -> {:>9.3f} s ({:+.1%}){}'.format(stage, before[stage], current[stage], ratio - 1,
+                                                                   '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def write_report(report: Dict, path: str):
+    """ Writes the report as json file.
+    The report contains 'meta' (versions and machine) and 'cases', which maps case -> stage -> measurements.
+        Parameters:
+            report (Dict): report from run_benchmark
+            path (str): output path
+    """
+
+    with open(path, 'w') as json_file:
+        json.dump(report, json_file, indent=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the filters of additional_filter on the ISLES2015 cases.')
+    parser.add_argument('cases', nargs='*', help='case ids to use (default: all cases in the data directory)')
+    parser.add_argument('--data-dir', default=pipeline.DATA_DIR)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='benchmark.json', help='path of the report')
+    parser.add_argument('--baseline', help='saved report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slow down allowed by --baseline')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.cases or pipeline.discover_cases(args.data_dir), args.stages, args.repeats,
+                           args.data_dir)
+    write_report(report, args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        sys.exit(1 if regressions else 0)
+    for stage, total in summarise(report).items():
+        print('{:<20} {:>9.3f} s'.format(stage, total))
@@ -0,0 +1,59 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Sequence
+
+import SimpleITK as sitk
+import pipeline
+import volume_cache
+
+ALL_MODALITIES = (pipeline.FLAIR, pipeline.DWI, pipeline.T1, pipeline.T2, pipeline.REFERENCE)
+
+
+class CaseLoader:
+    """ Reads all modalities of an ISLES2015 case concurrently on a thread pool.
+
+    Reading starts as soon as the loader is created, the files are read through the volume_cache. Every modality is
+    available as a future, so the pipeline can already work on the Flair image while the other files are still being
+    decompressed.
+    """
+
+    def __init__(self, case_id: str, modalities: Sequence[str] = ALL_MODALITIES, data_dir: str = pipeline.DATA_DIR):
+        """
+        @param case_id: name of the case directory, e.g. '01'
+        @param modalities: the modalities to read (in this order)
+        @param data_dir: directory containing the case directories
+        """
+        self.case_id = case_id
+        self._executor = ThreadPoolExecutor(max_workers=len(modalities), thread_name_prefix='case-' + case_id)
+        self._futures = {}  # type: Dict[str, Future]
+        for modality in modalities:
+            self._futures[modality] = self._executor.submit(volume_cache.read_image,
+                                                            pipeline.case_path(case_id, modality, data_dir))
+
+    def future(self, modality: str) -> Future:
+        """ Get the future of a modality without waiting for it.
+
+        @param modality: one of the modalities given to the constructor
+        @return: future resolving to the sitk.Image (or raising the read error)
+        """
+        return self._futures[modality]
+
+    def __getitem__(self, modality: str) -> sitk.Image:
+        """ Get the image of a modality, waits until it is read.
+
+        @param modality: one of the modalities given to the constructor
+        @return: the image
+        """
+        return self._futures[modality].result()
+
+    def close(self):
+        """ Cancels all reads that have not started yet and releases the thread pool.
+        """
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
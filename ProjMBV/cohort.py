@@ -0,0 +1,158 @@
+import argparse
+import csv
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Union
+
+import additional_filter as filter
+import array_backend
+import evaluation
+import pipeline
+import thread_budget
+from case_loader import CaseLoader
+
+# columns of the results table
+FIELDS = ['Case', 'Modality'] + evaluation.METRICS + ['Volume', 'Time', 'CPU']
+
+
+def run_case(case_id: str, data_dir: str = pipeline.DATA_DIR, speculative: bool = False,
+             options: Dict = None) -> Dict[str, Union[str, float]]:
+    """ Segments one case like segmentation.py does (Flair first, DWI if Flair finds nothing), but without
+    any viewer, and evaluates the result against the reference segmentation.
+        Parameters:
+            case_id (str): name of the case directory
+            data_dir (str): directory containing the case directories
+            speculative (bool): run the Flair and DWI chain at the same time (see pipeline.segment_speculative)
+            options (Dict): roi, pyramid, streaming mode, diffusion and backend (see pipeline.segment)
+        Returns: one row of the results table
+    """
+
+    start = time.perf_counter()
+    # cpu time of all threads of this process (not of the processes of the speculative mode)
+    cpu_start = time.process_time()
+    options = options or {}
+    # with a memory budget the chain reads the Flair and DWI image slab by slab from their files
+    # (see pipeline.segment_streamed), only the reference is loaded
+    streamed = options.get('memory_budget') is not None and not options.get('roi') and \
+        options.get('pyramid') is None and options.get('backend') is None
+    modalities = (pipeline.REFERENCE,) if streamed else (pipeline.FLAIR, pipeline.DWI, pipeline.REFERENCE)
+    with CaseLoader(case_id, modalities, data_dir) as case:
+        if streamed:
+            flair, dwi = pipeline.case_path(case_id, pipeline.FLAIR, data_dir), \
+                pipeline.case_path(case_id, pipeline.DWI, data_dir)
+        else:
+            flair, dwi = case[pipeline.FLAIR], case[pipeline.DWI]
+        modality = pipeline.FLAIR
+        if speculative:
+            modality, _, segmentation = pipeline.segment_speculative(flair, dwi, **options)
+        else:
+            _, segmentation = pipeline.segment_flair(flair, **options)
+        if segmentation is None and modality == pipeline.FLAIR:
+            modality = pipeline.DWI
+            _, segmentation = pipeline.segment_dwi(dwi, **options)
+
+        row = {'Case': case_id, 'Modality': modality}
+        row.update(pipeline.evaluate(segmentation, case[pipeline.REFERENCE]))
+    row['Time'] = time.perf_counter() - start
+    row['CPU'] = time.process_time() - cpu_start
+    return row
+
+
+def run_cohort(case_ids: List[str], data_dir: str = pipeline.DATA_DIR, workers: int = None,
+               speculative: bool = False, options: Dict = None,
+               budget: thread_budget.ThreadBudget = None) -> List[Dict]:
+    """ Runs run_case for every case on a process pool.
+        Parameters:
+            case_ids (List[str]): cases to segment
+            data_dir (str): directory containing the case directories
+            workers (int): number of processes, defaults to the number of cores (ignored if a budget is given)
+            speculative (bool): run the Flair and DWI chain of each case at the same time
+            options (Dict): roi, pyramid, streaming mode, diffusion and backend (see pipeline.segment)
+            budget (thread_budget.ThreadBudget): splits the cores between the processes and the filter threads,
+                defaults to one process per core with one thread per filter
+        Returns: rows of the results table in the order of case_ids
+    """
+
+    if budget is None:
+        budget = thread_budget.ThreadBudget(thread_budget.PROCESS, workers,
+                                            processes_per_worker=2 if speculative else 1)
+    n = len(case_ids)
+    with ProcessPoolExecutor(max_workers=min(budget.workers, n), initializer=thread_budget.apply,
+                             initargs=(budget,)) as executor:
+        return list(executor.map(run_case, case_ids, [data_dir] * n, [speculative] * n, [options] * n))
+
+
+def write_results(rows: List[Dict], path: str):
+    """ Writes the results table as csv file.
+        Parameters:
+            rows (List[Dict]): rows returned by run_case
+            path (str): output path
+    """
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segments every case of the ISLES2015 training data in parallel.')
+    parser.add_argument('cases', nargs='*', help='case ids to segment (default: all cases in the data directory)')
+    parser.add_argument('--data-dir', default=pipeline.DATA_DIR)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cores)')
+    parser.add_argument('--output', default='results.csv', help='path of the results table')
+    parser.add_argument('--speculative', action='store_true',
+                        help='run the Flair and DWI chain of each case at the same time')
+    parser.add_argument('--roi', action='store_true', help='only process the bounding box of the brain')
+    parser.add_argument('--pyramid', type=int, default=None, metavar='FACTOR',
+                        help='find lesion candidates on the image downsampled by FACTOR first')
+    parser.add_argument('--memory-budget', type=int, default=None, metavar='MB',
+                        help='read the images slab by slab and run the chain on z-slabs of at most MB megabytes '
+                             '(with --roi or --pyramid the images are read as a whole, only the buffers of smoothing '
+                             'and morphology are bounded); approximate, the smoothing scales with each slab')
+    parser.add_argument('--diffusion', default=None, choices=filter.DIFFUSION_MODES,
+                        help='smoothing mode (default: anisotropic), curvature and gaussian are faster, but less exact')
+    parser.add_argument('--diffusion-iterations', type=int, default=None, metavar='N',
+                        help='maximum number of smoothing iterations (default: {})'.format(filter.DIFFUSION_ITERATIONS))
+    parser.add_argument('--diffusion-tolerance', type=float, default=None, metavar='CHANGE',
+                        help='stop smoothing when an iteration changes the voxels by less than CHANGE on average')
+    parser.add_argument('--diffusion-threads', type=int, default=None, metavar='N',
+                        help='number of threads of the smoothing filter')
+    parser.add_argument('--backend', default=None, choices=array_backend.CHOICES,
+                        help='run the chain on arrays, every operation with sitk, numpy or the faster of both '
+                             '(auto, measured once per machine), not together with --roi, --pyramid or --memory-budget')
+    parser.add_argument('--threads-policy', default=thread_budget.PROCESS, choices=thread_budget.POLICIES,
+                        help='process: cases side by side with few threads each (default), '
+                             'filter: one case at a time with all threads')
+    parser.add_argument('--stage-threads', nargs='+', default=[], metavar='STAGE=N',
+                        help='number of threads for single stages, e.g. gradient=2')
+    args = parser.parse_args()
+    if args.backend is not None and (args.roi or args.pyramid is not None or args.memory_budget is not None):
+        parser.error('--backend runs on the whole image, it cannot be combined with --roi, --pyramid or '
+                     '--memory-budget')
+
+    cases = args.cases or pipeline.discover_cases(args.data_dir)
+    # only the given settings, so that the default smoothing shares its cached results with the other scripts
+    diffusion = {name: value for name, value in (('iterations', args.diffusion_iterations),
+                                                 ('tolerance', args.diffusion_tolerance),
+                                                 ('threads', args.diffusion_threads), ('mode', args.diffusion))
+                 if value is not None}
+    budget = thread_budget.ThreadBudget(args.threads_policy, args.workers,
+                                        processes_per_worker=2 if args.speculative else 1,
+                                        stage_threads={stage: int(count) for stage, count in
+                                                       (item.split('=') for item in args.stage_threads)})
+    if args.backend == array_backend.AUTO:
+        # measured and stored before the workers start, so that they do not all measure at the same time
+        array_backend.selector()
+    start = time.perf_counter()
+    results = run_cohort(cases, args.data_dir, args.workers, args.speculative,
+                         {'roi': args.roi, 'pyramid': args.pyramid,
+                          'memory_budget': args.memory_budget and args.memory_budget * 2 ** 20,
+                          'diffusion': diffusion, 'backend': args.backend}, budget)
+    wall_time = time.perf_counter() - start
+    write_results(results, args.output)
+
+    for row in results:
+        print('{Case}: {Modality} Dice {Dice:.3f}, {Time:.1f} s'.format(**row))
+    print('{} cases in {:.1f} s, results written to {}'.format(len(results), wall_time, args.output))
+    print(thread_budget.report(budget, results, wall_time))
@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import SimpleITK as sitk
+import numpy as np
+from roi import bounding_box
+
+# columns of the table returned by evaluate_many (besides 'Case')
+METRICS = ['Dice', 'Jaccard', 'Sensitivity', 'Precision', 'Hausdorff', 'HD95']
+
+
+def as_mask(image: Union[sitk.Image, np.ndarray]) -> np.ndarray:
+    """ Converts a segmentation into a compact binary array.
+        Parameters:
+            image (sitk.Image or np.ndarray): segmentation, every value != 0 is object
+        Returns: uint8 array in numpy (z, y, x) order
+    """
+
+    if isinstance(image, sitk.Image):
+        image = sitk.GetArrayViewFromImage(image)
+    return (image != 0).view(np.uint8)
+
+
+def _distance_map(mask: np.ndarray, spacing: Sequence[float]) -> np.ndarray:
+    """ Euclidean distance of every voxel to the nearest object voxel of the mask (0 inside the object). """
+    image = sitk.GetImageFromArray(mask)
+    image.SetSpacing(tuple(spacing))
+    distance = sitk.SignedMaurerDistanceMap(image, insideIsPositive=False, squaredDistance=False,
+                                            useImageSpacing=True)
+    return np.maximum(sitk.GetArrayViewFromImage(distance), 0)
+
+
+def overlap_metrics(prediction: np.ndarray, reference: np.ndarray,
+                    spacing: Sequence[float] = (1.0, 1.0, 1.0)) -> Dict[str, float]:
+    """ Computes overlap and distance metrics of two binary masks.
+    All counts come from one bincount over both masks. The distance maps are only computed once per mask, inside
+    the bounding box of both masks (which gives the exact distances), and are used for both directions.
+    Hausdorff is defined like in sitk.HausdorffDistanceImageFilter (over all object voxels), HD95 is the maximum
+    of the two directed 95th percentiles.
+        Parameters:
+            prediction (np.ndarray): uint8 mask from as_mask
+            reference (np.ndarray): uint8 mask from as_mask with the same shape
+            spacing (Sequence[float]): voxel spacing in sitk (x, y, z) order
+        Returns: dict with all METRICS, NaN where a metric is not defined
+    """
+
+    # 0: background, 1: only reference, 2: only prediction, 3: both
+    counts = np.bincount((prediction * 2 + reference).ravel(), minlength=4)
+    false_negative, false_positive, true_positive = (float(c) for c in counts[1:4])
+
+    def ratio(numerator, denominator):
+        return numerator / denominator if denominator > 0 else np.nan
+
+    results = {
+        'Dice': ratio(2 * true_positive, 2 * true_positive + false_positive + false_negative),
+        'Jaccard': ratio(true_positive, true_positive + false_positive + false_negative),
+        'Sensitivity': ratio(true_positive, true_positive + false_negative),
+        'Precision': ratio(true_positive, true_positive + false_positive),
+        'Hausdorff': np.nan,
+        'HD95': np.nan,
+    }
+    if true_positive + false_positive == 0 or true_positive + false_negative == 0:
+        return results
+
+    # crop both masks to the bounding box of their union
+    box = bounding_box(prediction | reference)
+    prediction, reference = prediction[box], reference[box]
+
+    to_prediction = _distance_map(prediction, spacing)[reference != 0]
+    to_reference = _distance_map(reference, spacing)[prediction != 0]
+    results['Hausdorff'] = float(max(to_prediction.max(), to_reference.max()))
+    results['HD95'] = float(max(np.percentile(to_prediction, 95), np.percentile(to_reference, 95)))
+    return results
+
+
+def evaluate_pair(prediction: Optional[Union[sitk.Image, np.ndarray]], reference: Union[sitk.Image, np.ndarray],
+                  spacing: Sequence[float] = None) -> Dict[str, float]:
+    """ Evaluates one segmentation against its reference.
+        Parameters:
+            prediction (sitk.Image or np.ndarray): our segmentation, None counts as empty segmentation
+            reference (sitk.Image or np.ndarray): reference segmentation
+            spacing (Sequence[float]): voxel spacing, taken from the reference image if not given
+        Returns: dict with all METRICS
+    """
+
+    if spacing is None:
+        spacing = reference.GetSpacing() if isinstance(reference, sitk.Image) else (1.0, 1.0, 1.0)
+    reference = as_mask(reference)
+    prediction = np.zeros_like(reference) if prediction is None else as_mask(prediction)
+    return overlap_metrics(prediction, reference, spacing)
+
+
+def _evaluate_row(case: Tuple[str, np.ndarray, np.ndarray, Sequence[float]]) -> Dict[str, Union[str, float]]:
+    case_id, prediction, reference, spacing = case
+    row = {'Case': case_id}
+    row.update(overlap_metrics(prediction, reference, spacing))
+    return row
+
+
+def evaluate_many(pairs: Sequence[Tuple[Optional[Union[sitk.Image, np.ndarray]], Union[sitk.Image, np.ndarray]]],
+                  case_ids: Sequence[str] = None, workers: int = None) -> List[Dict[str, Union[str, float]]]:
+    """ Evaluates many (prediction, reference) pairs on a process pool.
+    The images are converted into uint8 masks before they are sent to the workers.
+        Parameters:
+            pairs (Sequence[Tuple]): (prediction, reference) pairs as accepted by evaluate_pair
+            case_ids (Sequence[str]): names of the pairs, defaults to their index
+            workers (int): number of processes, defaults to the number of cores
+        Returns: one row with 'Case' and all METRICS per pair, in the order of pairs
+    """
+
+    if case_ids is None:
+        case_ids = [str(i) for i in range(len(pairs))]
+
+    cases = []
+    for case_id, (prediction, reference) in zip(case_ids, pairs):
+        spacing = reference.GetSpacing() if isinstance(reference, sitk.Image) else (1.0, 1.0, 1.0)
+        reference = as_mask(reference)
+        prediction = np.zeros_like(reference) if prediction is None else as_mask(prediction)
+        cases.append((case_id, prediction, reference, spacing))
+
+    workers = min(workers or os.cpu_count(), len(cases))
+    if workers <= 1:
+        return [_evaluate_row(case) for case in cases]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_evaluate_row, cases))
@@ -1,6 +1,7 @@
 import SimpleITK as sitk
 import sys
 import image_viewing as vis
+import volume_cache
 
 assert len(sys.argv) > 1, 'No input image specified'
 
@@ -8,7 +9,7 @@ assert len(sys.argv) > 1, 'No input image specified'
 # uses image viewing methods to get seed points for region growing with fixed thresholds and show results
 
 # load example image from argv
-input_image = sitk.ReadImage(sys.argv[1])
+input_image = volume_cache.read_image(sys.argv[1])
 vis.show_image(input_image, 'Input Image', blocking=False)
 
 # pre-processing
@@ -51,7 +51,19 @@ def show_and_return_markers(image: sitk.Image, window_title: str = '') -> List[L
     return markers
 
 
-def _show_image(image: sitk.Image, window_title: str = '', blocking: bool = True, mask: ImageMask = None, return_markers: bool = False) -> Union[int, List[List[int]]]:
+def show_and_return_image(image: sitk.Image, window_title: str = '') -> sitk.Image:
+    """ Display an image and return it including all changes made by key-actions in the viewer.
+
+    @param image: the image to show
+    @param window_title: optional window title of the viewer application
+    @return: the image after the viewer has been closed
+    """
+    # blocking is always true in this use case
+    return _show_image(image, window_title, return_image=True, blocking=True)
+
+
+def _show_image(image: sitk.Image, window_title: str = '', blocking: bool = True, mask: ImageMask = None,
+                return_markers: bool = False, return_image: bool = False) -> Union[int, List[List[int]], sitk.Image]:
     """ Function to access all image viewing functionality (do not call this directly!)
 
     @param image: the image to show
@@ -59,7 +71,9 @@ def _show_image(image: sitk.Image, window_title: str = '', blocking: bool = True
     @param blocking: if set to true, the viewer will be shown and following code is continued after the viewer is closed
     @param mask: an optional image mask to show on top of the image
     @param return_markers: if true, a list of markers manually placed in the viewer, otherwise the execution code is returned.
-    @return: execution code of the viewer application if return_markers is false, otherwise the markers are returned.
+    @param return_image: if true, the image of the viewer (with all changes made by key-actions) is returned.
+    @return: execution code of the viewer application if return_markers and return_image are false,
+             otherwise the markers or the image are returned.
     """
     # get the active Qt application or create a new one
     if QApplication.instance() is None:
@@ -79,6 +93,8 @@ def _show_image(image: sitk.Image, window_title: str = '', blocking: bool = True
     if return_markers:
         # get the user input of the new viewer
         return widget.get_markers_for_region_growing()
+    elif return_image:
+        return widget.get_image()
     else:
         return exec_code
 
@@ -0,0 +1,288 @@
+import functools
+from typing import Dict, List, Sequence, Tuple, Union
+
+import SimpleITK as sitk
+import numpy as np
+
+from profiling import profiled
+from roi import bounding_box
+
+# a step of a fused chain: (name, parameters), e.g. ('closing', {'radius': (2, 2, 2)})
+Step = Tuple[str, Dict]
+STEPS = ('opening', 'closing', 'dilate', 'erode', 'hole_filling')
+
+# voting threshold of sitk.VotingBinaryIterativeHoleFillingImageFilter
+MAJORITY_THRESHOLD = 1
+
+# engines of hole_filling: the iterative voting of sitk fills holes slowly and smoothes the border,
+# FILL and FILL_SLICES fill every hole exactly in one pass (background not connected to the image border,
+# in 3D or in every axial slice); the voting can follow them as smoothing
+VOTING = 'voting'
+FILL = 'fill'
+FILL_SLICES = 'fill_slices'
+HOLE_FILLING_ENGINES = (VOTING, FILL, FILL_SLICES)
+
+
+@functools.lru_cache(maxsize=None)
+def ball_offsets(radius: Tuple[int, ...]) -> np.ndarray:
+    """ Gets the voxels of the ball structuring element sitk uses for binary morphology.
+        Parameters:
+            radius (Tuple[int, ...]): kernel radius in sitk (x, y, z) order
+        Returns: offsets from the center in numpy (z, y, x) order, one per row
+    """
+
+    point = sitk.Image([2 * r + 1 for r in radius], sitk.sitkUInt8)
+    point[tuple(radius)] = 1
+    ball = sitk.GetArrayFromImage(sitk.BinaryDilate(point, radius, sitk.sitkBall))
+    return np.argwhere(ball) - np.asarray(radius[::-1])
+
+
+def _as_radius(radius: Union[int, Sequence[int]], dimension: int) -> Tuple[int, ...]:
+    return (radius,) * dimension if isinstance(radius, int) else tuple(radius)
+
+
+def _reach(steps: List[Step], dimension: int) -> int:
+    """ Biggest radius of all steps. """
+    reach = 1
+    for name, params in steps:
+        if name == 'closing':
+            reach = max(reach, *_as_radius(params.get('radius', (2, 2, 2)), dimension))
+        elif name == 'hole_filling':
+            reach = max(reach, params.get('radius', 2))
+    return reach
+
+
+class _Buffers:
+    """ Two padded uint8 buffers of the same size the steps of a chain write into alternately.
+
+    The interior of the buffers is the cropped region of the image, the padding holds what a filter sees beyond
+    it: background on the sides inside the image, and the boundary condition of the filter on the image border.
+    """
+
+    def __init__(self, array: np.ndarray, padding: int, on_border: List[Tuple[bool, bool]]):
+        """
+        @param array: cropped binary array
+        @param padding: padding on every side, at least twice the biggest radius (for the safe border of closing)
+        @param on_border: for every axis, whether the lower and upper side of the crop are on the image border
+        """
+        self.padding = padding
+        self.on_border = on_border
+        self.source = np.zeros([n + 2 * padding for n in array.shape], dtype=np.uint8)
+        self.target = np.zeros_like(self.source)
+        self.interior = tuple(slice(padding, padding + n) for n in array.shape)
+        self.source[self.interior] = array == 1
+
+    def swap(self):
+        self.source, self.target = self.target, self.source
+
+    def _side(self, axis: int, upper: bool) -> Tuple[slice, ...]:
+        side = slice(-self.padding, None) if upper else slice(0, self.padding)
+        return (slice(None),) * axis + (side,)
+
+    def fill_padding(self, border_value: int = None):
+        """ Sets the padding of the source to background, and on the image border to border_value
+        (None copies the border voxels outwards, like the zero flux Neumann boundary condition of itk).
+        """
+        for axis in range(self.source.ndim):
+            for upper in (False, True):
+                self.source[self._side(axis, upper)] = 0
+        for axis in range(self.source.ndim):
+            for upper, is_border in zip((False, True), self.on_border[axis]):
+                if not is_border:
+                    continue
+                if border_value is not None:
+                    self.source[self._side(axis, upper)] = border_value
+                else:
+                    edge = self.padding + self.source.shape[axis] - 2 * self.padding - 1 if upper else self.padding
+                    edge_slice = (slice(None),) * axis + (slice(edge, edge + 1),)
+                    self.source[self._side(axis, upper)] = self.source[edge_slice]
+
+    def shifted(self, offset: Sequence[int], reach: int) -> Tuple[slice, ...]:
+        """ Slices of the source shifted by offset, for the region which is reach voxels away from the buffer edge. """
+        return tuple(slice(reach + o, n - reach + o) for o, n in zip(offset, self.source.shape))
+
+    def region(self, reach: int) -> Tuple[slice, ...]:
+        return tuple(slice(reach, n - reach) for n in self.source.shape)
+
+    def morphology(self, offsets: np.ndarray, dilate: bool):
+        """ Dilates (or erodes) the source with the structuring element into the target and swaps them. """
+        reach = int(np.abs(offsets).max())
+        region = self.region(reach)
+        combine = np.bitwise_or if dilate else np.bitwise_and
+        target = self.target[region]
+        target[...] = self.source[self.shifted(offsets[0], reach)]
+        for offset in offsets[1:]:
+            combine(target, self.source[self.shifted(offset, reach)], out=target)
+        self.swap()
+
+    def fill_holes(self, slice_wise: bool):
+        """ Sets all background of the source to foreground, which is not connected to the padding.
+        The padding is background all around, which is the same as flooding the background from the image border.
+        """
+        self.fill_padding(0)
+        planes = self.source if slice_wise else [self.source]
+        for plane in planes:
+            if plane.any():
+                filled = sitk.BinaryFillhole(sitk.GetImageFromArray(plane))
+                plane[...] = sitk.GetArrayViewFromImage(filled)
+
+    def voting(self, radius: int, iterations: int, counts: List[np.ndarray]) -> List[int]:
+        """ Iterative hole filling like sitk.VotingBinaryIterativeHoleFillingImageFilter (foreground 1).
+        Returns the number of changed voxels of every iteration, the voting has converged if the last one is 0.
+        counts are one buffer per axis for the neighbourhood sums, their dtype has to hold (2 * radius + 1) ** ndim.
+        """
+        changes = []
+        dimension = self.source.ndim
+        # background voxels become foreground, if more than half of the neighbourhood is foreground
+        birth = (2 * radius + 1) ** dimension // 2 + MAJORITY_THRESHOLD
+        region = self.region(radius)
+        for _ in range(iterations):
+            self.fill_padding(None)
+            # neighbourhood sums, one axis after the other
+            total = self.source
+            for axis, count in enumerate(counts):
+                count.fill(0)
+                axis_region = tuple(slice(radius, n - radius) if a == axis else slice(None)
+                                    for a, n in enumerate(total.shape))
+                target = count[axis_region]
+                for shift in range(-radius, radius + 1):
+                    shifted = tuple(slice(radius + shift, n - radius + shift) if a == axis else slice(None)
+                                    for a, n in enumerate(total.shape))
+                    np.add(target, total[shifted], out=target)
+                total = count
+            born = (self.source[region] == 0) & (total[region] >= birth)
+            changes.append(int(np.count_nonzero(born)))
+            if changes[-1] == 0:
+                break
+            self.source[region][born] = 1
+        return changes
+
+
+@profiled
+def fused_morphology(image: sitk.Image, steps: List[Step], convergence: List[List[int]] = None) -> sitk.Image:
+    """ Runs a chain of binary morphology filters of additional_filter as one operation.
+    The chain only works on the bounding box of the foreground (plus a margin), in two buffers which are reused by
+    every step. The result is the same as running the filters one after the other on the whole image:
+    opening, dilate and erode use the ball of sitk, closing has a safe border, and hole_filling votes like
+    sitk.VotingBinaryIterativeHoleFillingImageFilter (after the exact fill of its engine, see HOLE_FILLING_ENGINES).
+        Parameters:
+            image (sitk.Image): binary image (0 and 1)
+            steps (List[Step]): e.g. [('opening', {}), ('closing', {'radius': (2, 2, 2)}), ('dilate', {}),
+                ('hole_filling', {'radius': 2, 'iterations': 20, 'engine': VOTING})]
+            convergence (List[List[int]]): if given, the changed voxels of every voting iteration of every
+                hole_filling step are appended to it
+        Returns: uint8 image after the last step
+    """
+
+    output = sitk.GetImageFromArray(fused_morphology_array(sitk.GetArrayViewFromImage(image), steps, convergence))
+    output.CopyInformation(image)
+    return output
+
+
+def fused_morphology_array(array: np.ndarray, steps: List[Step], convergence: List[List[int]] = None) -> np.ndarray:
+    """ fused_morphology on an array in numpy (z, y, x) order.
+        Parameters:
+            array (np.ndarray): binary array (0 and 1)
+            steps (List[Step]): see fused_morphology
+            convergence (List[List[int]]): see fused_morphology
+        Returns: uint8 array after the last step
+    """
+
+    unknown = [name for name, _ in steps if name not in STEPS]
+    if unknown:
+        raise ValueError('Unknown steps {}. Choose from {}.'.format(unknown, STEPS))
+    engines = [params.get('engine', VOTING) for name, params in steps if name == 'hole_filling']
+    if any(engine not in HOLE_FILLING_ENGINES for engine in engines):
+        raise ValueError('Unknown engine in {}. Choose from {}.'.format(engines, HOLE_FILLING_ENGINES))
+
+    dimension = array.ndim
+    result = np.zeros(array.shape, dtype=np.uint8)
+    box = bounding_box(array == 1)
+    if box is not None:
+        reach = _reach(steps, dimension)
+        # the result of the chain is at most one voxel bigger than the box
+        margin = 2 * reach + 2
+        box = tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(box, array.shape))
+        on_border = [(s.start == 0, s.stop == n) for s, n in zip(box, array.shape)]
+        buffers = _Buffers(array[box], 2 * reach, on_border)
+
+        unit_ball = ball_offsets((1,) * dimension)
+        counts = None
+        for name, params in steps:
+            if name in ('opening', 'erode'):
+                # the binary erosion of sitk sets everything outside of the image to foreground
+                buffers.fill_padding(1)
+                buffers.morphology(unit_ball, dilate=False)
+            if name in ('opening', 'dilate'):
+                buffers.fill_padding(0)
+                buffers.morphology(unit_ball, dilate=True)
+            if name == 'closing':
+                # safe border: the image is padded with background, so the erosion sees the dilated padding
+                offsets = ball_offsets(_as_radius(params.get('radius', (2, 2, 2)), dimension))
+                buffers.fill_padding(0)
+                buffers.morphology(offsets, dilate=True)
+                buffers.morphology(offsets, dilate=False)
+            if name == 'hole_filling':
+                engine = params.get('engine', VOTING)
+                if engine != VOTING:
+                    buffers.fill_holes(slice_wise=engine == FILL_SLICES)
+                iterations = params.get('iterations', 20)
+                if iterations == 0:
+                    continue
+                radius = params.get('radius', 2)
+                # the sums reach (2 * radius + 1) ** dimension, uint8 only holds them up to radius 2
+                count_type = np.min_scalar_type((2 * radius + 1) ** dimension)
+                if counts is None or counts[0].dtype != count_type:
+                    counts = [np.zeros(buffers.source.shape, dtype=count_type) for _ in range(dimension)]
+                changes = buffers.voting(radius, iterations, counts)
+                if convergence is not None:
+                    convergence.append(changes)
+        result[box] = buffers.source[buffers.interior]
+    return result
+
+
+def _sitk_step(image: sitk.Image, name: str, params: Dict) -> sitk.Image:
+    """ Runs a step of a chain with the sitk filter additional_filter uses for it. """
+    if name == 'opening':
+        return sitk.BinaryMorphologicalOpeningImageFilter().Execute(image)
+    if name == 'closing':
+        close_filter = sitk.BinaryMorphologicalClosingImageFilter()
+        close_filter.SetKernelRadius(params.get('radius', (2, 2, 2)))
+        return close_filter.Execute(image)
+    if name == 'dilate':
+        return sitk.BinaryDilateImageFilter().Execute(image)
+    if name == 'erode':
+        return sitk.BinaryErodeImageFilter().Execute(image)
+    radius = params.get('radius', 2)
+    return sitk.VotingBinaryIterativeHoleFilling(image, [radius] * image.GetDimension(),
+                                                 params.get('iterations', 20), MAJORITY_THRESHOLD, 1, 0)
+
+
+def compare_with_sitk(array: np.ndarray, steps: List[Step]) -> int:
+    """ Compares a fused chain with the sitk filters run one after the other.
+        Parameters:
+            array (np.ndarray): binary array (0 and 1)
+            steps (List[Step]): see fused_morphology
+        Returns: number of differing voxels
+    """
+
+    image = sitk.GetImageFromArray(array)
+    for name, params in steps:
+        image = _sitk_step(image, name, params)
+    expected = sitk.GetArrayFromImage(image)
+    return int(np.count_nonzero(fused_morphology_array(array, steps) != expected))
+
+
+if __name__ == '__main__':
+    # noisy blobs with holes of every size, touching the image border
+    rng = np.random.default_rng(0)
+    blobs = (rng.random((48, 64, 64)) < 0.4).astype(np.uint8)
+    blobs[8:40, 4:60, 10:64] |= (rng.random((32, 56, 54)) < 0.85).astype(np.uint8)
+    for radius in (1, 2, 3):
+        chain = [('opening', {}), ('closing', {'radius': (radius,) * blobs.ndim}), ('dilate', {}), ('erode', {}),
+                 ('hole_filling', {'radius': radius, 'iterations': 20})]
+        # every step on its own and the whole chain
+        for steps in [[step] for step in chain] + [chain]:
+            count = compare_with_sitk(blobs, steps)
+            print('radius {} {:<45} {}'.format(radius, ', '.join(name for name, _ in steps),
+                                                'same as sitk' if count == 0 else '{} voxels differ'.format(count)))
@@ -0,0 +1,386 @@
+import functools
+import os
+import multiprocessing
+import SimpleITK as sitk
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import additional_filter as filter
+import evaluation
+import morphology
+import roi as region
+import stage_cache
+import streaming
+import volume_cache
+from profiling import profiled
+
+
+DATA_DIR = 'ISLES2015_Train'
+
+FLAIR = 'MR_Flair'
+DWI = 'MR_DWI'
+T1 = 'MR_T1'
+T2 = 'MR_T2'
+REFERENCE = 'OT'
+
+
+def case_path(case_id: str, modality: str, data_dir: str = DATA_DIR) -> str:
+    """ Builds the path of one modality of an ISLES2015 case.
+        Parameters:
+            case_id (str): name of the case directory, e.g. '01'
+            modality (str): one of FLAIR, DWI, T1, T2 or REFERENCE
+            data_dir (str): directory containing the case directories
+        Returns: path to the NIfTI file
+    """
+
+    return os.path.join(data_dir, case_id, 'VSD.Brain.' + case_id + '.O.' + modality + '_reg.nii.gz')
+
+
+def discover_cases(data_dir: str = DATA_DIR) -> List[str]:
+    """ Searches for every case directory which contains at least a Flair image and a reference segmentation.
+        Parameters:
+            data_dir (str): directory containing the case directories
+        Returns: sorted list of case ids
+    """
+
+    cases = []
+    for case_id in sorted(os.listdir(data_dir)):
+        if os.path.isfile(case_path(case_id, FLAIR, data_dir)) and \
+                os.path.isfile(case_path(case_id, REFERENCE, data_dir)):
+            cases.append(case_id)
+    return cases
+
+
+# parameters of the chain, the DWI chain uses a lower threshold and no dilation
+FLAIR_PARAMETERS = {'seed_cutoff': 495, 'lower': 490, 'upper': 500, 'closing_radius': (2, 2, 2), 'dilate': True,
+                    'hole_radius': 2, 'hole_iterations': 20, 'hole_engine': filter.VOTING, 'minimum_size': 200}
+DWI_PARAMETERS = dict(FLAIR_PARAMETERS, lower=470, dilate=False)
+
+
+def _local_filter(stage, image: sitk.Image, memory_budget: int = None, **params) -> sitk.Image:
+    """ Runs a local filter on the whole image, or slab-wise if a memory budget is given (see streaming). """
+    if memory_budget is None:
+        return stage(image, **params)
+    return streaming.run_slabwise(stage, image, memory_budget, **params)
+
+
+def preprocess(input_image: sitk.Image, box: region.Box = None, memory_budget: int = None,
+               diffusion: Dict = None) -> Tuple[sitk.Image, sitk.Image]:
+    """ Normalises and smoothes an image. Both stages are cached on disk (see stage_cache),
+    so changing only the later stages does not recompute them.
+        Parameters:
+            input_image (sitk.Image): brain-MRT image
+            box (region.Box): if given, only this region is smoothed (see roi.brain_box)
+            memory_budget (int): if given, the smoothing runs slab-wise with this many bytes of working buffers
+                per slab
+            diffusion (Dict): parameters of filter.gradient, e.g. {'iterations': 3, 'mode': filter.CURVATURE}
+        Returns: the normalised image (always full-size) and the smoothed image
+    """
+
+    diffusion = diffusion or {}
+    # normalise image to [0,500] and remove measurement errors below the 5th and above the 99th percentile
+    # (on the whole image, the percentiles would change with the background in the box)
+    normalised_image = stage_cache.cached(filter.normalise, input_image)
+    # image smoothing with edge preservation
+    cropped_image = normalised_image if box is None else region.crop(normalised_image, box)
+    if memory_budget is None:
+        grad_image = stage_cache.cached(filter.gradient, cropped_image, **diffusion)
+    else:
+        grad_image = stage_cache.cached(streaming.slab_gradient, cropped_image, memory_budget=memory_budget,
+                                        **diffusion)
+    return normalised_image, grad_image
+
+
+def region_growing(grad_image: sitk.Image, seed_cutoff: float, lower: float, upper: float,
+                   box: region.Box = None, engine: str = filter.FLOOD, seed_image: sitk.Image = None,
+                   seed_box: region.Box = None) -> sitk.Image:
+    """ Grows the lesion from every voxel brighter than seed_cutoff.
+        Parameters:
+            grad_image (sitk.Image): smoothed image from preprocess
+            seed_cutoff (float): minimum intensity of a seedpoint
+            lower (float): lower border of the threshold
+            upper (float): upper border of the threshold
+            box (region.Box): the box grad_image has been cropped to, if any
+            engine (str): engine of additional_filter.threshold, both give the same result
+            seed_image (sitk.Image): smoothed image of seed_box the seedpoints are taken from (default: grad_image),
+                see region.seed_box
+            seed_box (region.Box): the box seed_image has been cropped to
+        Returns: binary sitk.Image
+    """
+
+    manual = filter.manual_seeds()
+    seeds = filter.seedpoints(grad_image if manual or seed_image is None else seed_image, seed_cutoff)
+    # markers set in the viewer already are sitk indices of the image shown, which is the cropped one
+    if box is not None and not manual:
+        seeds = region.shift_seeds(seeds, box, None if seed_image is None else seed_box)
+    if engine == filter.FLOOD:
+        # one seedpoint per bright blob gives the same region as all of them
+        seeds = filter.reduce_seeds(grad_image, seeds, seed_cutoff, lower, upper)
+    return filter.threshold(grad_image, seeds, lower, upper, engine)
+
+
+def postprocess(thresh_image: sitk.Image, closing_radius: Sequence[int], dilate: bool, hole_radius: int,
+                hole_iterations: int, minimum_size: int, memory_budget: int = None,
+                hole_engine: str = filter.VOTING) -> Optional[sitk.Image]:
+    """ Cleans the region growing result with opening, closing, dilation and hole filling
+    and chooses the biggest connected component.
+        Parameters:
+            thresh_image (sitk.Image): binary image from region_growing
+            closing_radius (Sequence[int]): kernel radius of the closing
+            dilate (bool): dilate after the closing
+            hole_radius (int): radius of the hole filling
+            hole_iterations (int): maximum number of iterations of the hole filling
+            minimum_size (int): minimum number of voxels of the segmentation
+            memory_budget (int): if given, the morphology runs filter by filter and slab-wise with this many bytes
+                of working buffers per slab, otherwise as one fused chain; the connected components are always
+                computed on the whole image
+            hole_engine (str): engine of the hole filling (see filter.hole_filling), the 3D fill always runs on the
+                whole image
+        Returns: the segmentation (None, if no lesion big enough was found)
+    """
+
+    if memory_budget is None:
+        # the whole chain runs as one operation on two reused buffers around the foreground
+        steps = [('opening', {}), ('closing', {'radius': closing_radius})]
+        if dilate:
+            steps.append(('dilate', {}))
+        steps.append(('hole_filling', {'radius': hole_radius, 'iterations': hole_iterations, 'engine': hole_engine}))
+        return filter.connected_component(morphology.fused_morphology(thresh_image, steps), minimum_size)
+
+    # every step replaces the previous image, so only two images of the chain are alive at a time
+    morph_image = _local_filter(filter.opening, thresh_image, memory_budget)
+    morph_image = _local_filter(filter.closing, morph_image, memory_budget, radius=closing_radius)
+    if dilate:
+        morph_image = _local_filter(filter.dilate, morph_image, memory_budget)
+    morph_image = _local_filter(filter.hole_filling, morph_image, None if hole_engine == filter.FILL else memory_budget,
+                                radius=hole_radius, iterations=hole_iterations, engine=hole_engine)
+
+    # choose the biggest connected component
+    return filter.connected_component(morph_image, minimum_size)
+
+
+def find_candidates(normalised_image: sitk.Image, parameters: Dict, factor: int, count: int = 3,
+                    diffusion: Dict = None) -> List[region.Box]:
+    """ Runs the smoothing and the region growing on a downsampled image to find where lesions could be.
+        Parameters:
+            normalised_image (sitk.Image): normalised image from preprocess
+            parameters (Dict): parameters like FLAIR_PARAMETERS
+            factor (int): downsampling factor
+            count (int): maximum number of candidates
+            diffusion (Dict): parameters of filter.gradient (see preprocess)
+        Returns: boxes around the biggest candidates in full resolution, including the margin the filters need
+    """
+
+    coarse_image = sitk.BinShrink(normalised_image, [factor] * normalised_image.GetDimension())
+    diffusion = diffusion or {}
+    coarse_grad_image = stage_cache.cached(filter.gradient, coarse_image, **diffusion)
+    coarse_thresh_image = region_growing(coarse_grad_image, parameters['seed_cutoff'], parameters['lower'],
+                                         parameters['upper'])
+    margin = region.chain_margin(parameters, filter.diffusion_reach(**diffusion)) + factor
+    return region.component_boxes(coarse_thresh_image, factor, margin, count, normalised_image.GetSize())
+
+
+def segment_streamed(path: str, parameters: Dict, memory_budget: int,
+                     diffusion: Dict = None) -> Tuple[sitk.Image, Optional[sitk.Image]]:
+    """ Runs the whole segmentation chain slab by slab from the image file, the input is never read as a whole.
+    The percentiles of normalise are counted slab by slab, the intensity window is applied to every slab right
+    before its smoothing, and the normalised image is only built at the end. The slab stages stay within the budget,
+    the peak memory comes from the stages which need the whole image: the region growing (smoothed float image and
+    its mask) and the connected components (32 bit labels). The stages are not cached on disk.
+    The diffusion scales with the mean gradient of each slab, so this only approximates segment (on case 01 with
+    64 MB slabs the segmentation differs from the whole-image chain by 1523 voxels).
+        Parameters:
+            path (str): path of the brain-MRT image
+            parameters (Dict): parameters like FLAIR_PARAMETERS
+            memory_budget (int): bytes one slab may use (see streaming.run_slabwise)
+            diffusion (Dict): parameters of filter.gradient (see preprocess)
+        Returns: the normalised image and the segmentation (None, if no lesion big enough was found)
+    """
+
+    lower_percentile, upper_percentile = streaming.slab_percentiles(path, (5, 99), memory_budget)
+    window = functools.partial(filter.intensity_window, minimum=lower_percentile, maximum=upper_percentile)
+    grad_image = streaming.run_slabwise(filter.gradient, path, memory_budget, transform=window, **(diffusion or {}))
+    thresh_image = region_growing(grad_image, parameters['seed_cutoff'], parameters['lower'], parameters['upper'])
+    del grad_image
+    segmentation = postprocess(thresh_image, parameters['closing_radius'], parameters['dilate'],
+                               parameters['hole_radius'], parameters['hole_iterations'], parameters['minimum_size'],
+                               memory_budget, parameters['hole_engine'])
+    del thresh_image
+    normalised_image = streaming.run_slabwise(filter.intensity_window, path, memory_budget,
+                                              minimum=lower_percentile, maximum=upper_percentile)
+    return normalised_image, segmentation
+
+
+def segment_arrays(input_image: sitk.Image, parameters: Dict, backend: str = None,
+                   diffusion: Dict = None) -> Tuple[sitk.Image, Optional[sitk.Image]]:
+    """ Runs the whole segmentation chain on arrays, every operation with the backend of array_backend.
+    The stages are not cached on disk.
+        Parameters:
+            input_image (sitk.Image): brain-MRT image
+            parameters (Dict): parameters like FLAIR_PARAMETERS
+            backend (str): array_backend.AUTO (the faster backend of every operation), SITK or NUMPY
+                (default: MBV_BACKEND)
+            diffusion (Dict): parameters of filter.gradient (see preprocess)
+        Returns: the normalised image and the segmentation (None, if no lesion big enough was found)
+    """
+
+    # only imported for the array chain, so that the other modes do not load its optional dependencies
+    import array_backend
+
+    normalised, mask = array_backend.segment(sitk.GetArrayFromImage(input_image), parameters,
+                                             input_image.GetSpacing(), diffusion, backend)
+    normalised_image = sitk.GetImageFromArray(normalised)
+    normalised_image.CopyInformation(input_image)
+    if mask is None:
+        return normalised_image, None
+    segmentation = sitk.GetImageFromArray(mask)
+    segmentation.CopyInformation(input_image)
+    return normalised_image, segmentation
+
+
+@profiled
+def segment(input_image: Union[sitk.Image, str], parameters: Dict, roi: bool = False,
+            pyramid: int = None, memory_budget: int = None,
+            diffusion: Dict = None, backend: str = None) -> Tuple[sitk.Image, Optional[sitk.Image]]:
+    """ Runs the whole segmentation chain.
+        Parameters:
+            input_image (sitk.Image or str): brain-MRT image, or its path (read as a whole without memory_budget)
+            parameters (Dict): parameters like FLAIR_PARAMETERS
+            roi (bool): run the chain only on the bounding box of the brain (plus the margin the filters need)
+                and paste the segmentation back into the full image. The diffusion scales with the mean gradient
+                of the whole box, so the result can differ slightly from the full image.
+            pyramid (int): if given, find lesion candidates on the image downsampled by this factor first
+                (see find_candidates) and run the chain in full resolution only on the boxes around them.
+                The seedpoints of a box come from its transposed box, like on the full image (see region.seed_box).
+                The biggest segmentation of all boxes is used. This is an approximation: each box is smoothed on
+                its own, and lesions the coarse image misses are lost.
+            memory_budget (int): if given, the smoothing and the morphology run on overlapping z-slabs
+                of at most this many bytes (see streaming.run_slabwise). With a path as input_image, the whole
+                chain is read from the file slab by slab (see segment_streamed, not together with roi, pyramid or
+                backend), with an image only the working buffers of these filters are bounded. The diffusion
+                scales with the mean gradient of each slab, so the result is an approximation.
+            diffusion (Dict): parameters of filter.gradient, e.g. fewer iterations, an early stop or a faster mode
+                for batch runs (see preprocess)
+            backend (str): if given, the chain runs on arrays with this backend of array_backend (AUTO, SITK or
+                NUMPY, see segment_arrays), always on the whole image, so not together with roi, pyramid or
+                memory_budget
+        Returns: the normalised image and the segmentation (None, if no lesion big enough was found)
+    """
+
+    if isinstance(input_image, str):
+        if memory_budget is not None:
+            if roi or pyramid is not None or backend is not None:
+                raise ValueError('The streamed chain runs on the whole image, without roi, pyramid or backend.')
+            return segment_streamed(input_image, parameters, memory_budget, diffusion)
+        input_image = volume_cache.read_image(input_image)
+    if backend is not None:
+        if roi or pyramid is not None or memory_budget is not None:
+            raise ValueError('The array backend runs on the whole image, without roi, pyramid or memory_budget.')
+        return segment_arrays(input_image, parameters, backend, diffusion)
+    if pyramid is not None:
+        boxes = find_candidates(stage_cache.cached(filter.normalise, input_image), parameters, pyramid,
+                                diffusion=diffusion)
+    elif roi:
+        boxes = [region.brain_box(input_image,
+                                  region.chain_margin(parameters, filter.diffusion_reach(**(diffusion or {}))))]
+    else:
+        boxes = [None]
+
+    normalised_image, segmentation, segmentation_size = None, None, 0
+    for box in boxes:
+        seed_box, seed_image = None, None
+        if pyramid is not None:
+            # the seedpoints of a candidate box lie in its transposed box (see region.seed_box), the brain box of
+            # roi already contains every bright voxel
+            seed_box = region.seed_box(box, input_image.GetSize())
+            if seed_box is None:
+                continue
+            seed_image = preprocess(input_image, seed_box, memory_budget, diffusion)[1]
+        normalised_image, grad_image = preprocess(input_image, box, memory_budget, diffusion)
+        thresh_image = region_growing(grad_image, parameters['seed_cutoff'], parameters['lower'],
+                                      parameters['upper'], box, seed_image=seed_image, seed_box=seed_box)
+        del grad_image, seed_image
+        box_segmentation = postprocess(thresh_image, parameters['closing_radius'], parameters['dilate'],
+                                       parameters['hole_radius'], parameters['hole_iterations'],
+                                       parameters['minimum_size'], memory_budget, parameters['hole_engine'])
+        del thresh_image
+        if box_segmentation is None:
+            continue
+        size = np.count_nonzero(sitk.GetArrayViewFromImage(box_segmentation))
+        if size > segmentation_size:
+            segmentation, segmentation_size = box_segmentation, size
+            if box is not None:
+                segmentation = region.paste(segmentation, input_image, box)
+
+    if normalised_image is None:
+        normalised_image = stage_cache.cached(filter.normalise, input_image)
+    return normalised_image, segmentation
+
+
+@profiled
+def segment_flair(input_image: Union[sitk.Image, str], **options) -> Tuple[sitk.Image, Optional[sitk.Image]]:
+    """ Runs the segmentation chain on a Flair image.
+        Parameters:
+            input_image (sitk.Image or str): Flair brain-MRT image or its path
+            options: roi, pyramid, streaming mode, diffusion and backend (see segment)
+        Returns: the normalised image and the segmentation (None, if no lesion big enough was found)
+    """
+
+    return segment(input_image, FLAIR_PARAMETERS, **options)
+
+
+@profiled
+def segment_dwi(input_image: Union[sitk.Image, str], **options) -> Tuple[sitk.Image, Optional[sitk.Image]]:
+    """ Runs the segmentation chain on a DWI image. It is used if the Flair chain finds no lesion.
+        Parameters:
+            input_image (sitk.Image or str): DWI brain-MRT image or its path
+            options: roi, pyramid, streaming mode, diffusion and backend (see segment)
+        Returns: the normalised image and the segmentation (None, if no lesion big enough was found)
+    """
+
+    return segment(input_image, DWI_PARAMETERS, **options)
+
+
+@profiled
+def segment_speculative(flair_image: Union[sitk.Image, str], dwi_image: Union[sitk.Image, str],
+                        **options) -> Tuple[str, sitk.Image, Optional[sitk.Image]]:
+    """ Runs the Flair and the DWI chain at the same time in two processes.
+    The DWI result is only used if the Flair chain finds no lesion, otherwise the DWI process is stopped.
+    So a case needs about as long as one chain instead of two, if the Flair chain fails.
+        Parameters:
+            flair_image (sitk.Image or str): Flair brain-MRT image or its path
+            dwi_image (sitk.Image or str): DWI brain-MRT image of the same case or its path
+            options: roi, pyramid, streaming mode, diffusion and backend (see segment)
+        Returns: the modality that has been used, its normalised image and the segmentation
+    """
+
+    pool = multiprocessing.Pool(processes=2)
+    try:
+        flair_result = pool.apply_async(segment_flair, (flair_image,), options)
+        dwi_result = pool.apply_async(segment_dwi, (dwi_image,), options)
+        normalised_image, segmentation = flair_result.get()
+        if segmentation is not None:
+            return FLAIR, normalised_image, segmentation
+        normalised_image, segmentation = dwi_result.get()
+        return DWI, normalised_image, segmentation
+    finally:
+        # discards the DWI chain if it is still running
+        pool.terminate()
+
+
+@profiled
+def evaluate(segmentation: Optional[sitk.Image], reference: sitk.Image) -> Dict[str, float]:
+    """ Compares a segmentation with the given reference segmentation.
+        Parameters:
+            segmentation (sitk.Image): our segmentation, may be None
+            reference (sitk.Image): reference segmentation (OT image)
+        Returns: dict with evaluation.METRICS and Volume (in mm^3), NaN if there is no segmentation
+    """
+
+    if segmentation is None:
+        return dict.fromkeys(evaluation.METRICS + ['Volume'], np.nan)
+
+    results = evaluation.evaluate_pair(segmentation, reference)
+    # calculate the volume of the segmentation
+    results['Volume'] = float(np.count_nonzero(sitk.GetArrayViewFromImage(segmentation)) * np.prod(segmentation.GetSpacing()))
+    return results
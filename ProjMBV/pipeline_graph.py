@@ -0,0 +1,227 @@
+import argparse
+import json
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import SimpleITK as sitk
+
+import additional_filter as filter
+import pipeline
+import stage_cache
+from case_loader import CaseLoader
+from profiling import profiled
+
+try:
+    import yaml
+except ImportError:  # only needed for .yaml descriptions
+    yaml = None
+
+
+@profiled
+def cast(image: sitk.Image, pixel_type: str) -> sitk.Image:
+    """ Casts an image, e.g. the labels for connected_component.
+        Parameters:
+            image (sitk.Image): any image
+            pixel_type (str): name of the sitk pixel type, e.g. 'sitkInt32'
+        Returns: the cast image
+    """
+
+    return sitk.Cast(image, getattr(sitk, pixel_type))
+
+
+# stages which can be used besides the filters of additional_filter
+STAGES = {'cast': cast, 'evaluate': pipeline.evaluate}
+# evaluates its inputs one after the other and returns the first one which is not None,
+# the remaining inputs are not computed
+FIRST = 'first'
+
+
+def find_stage(name: str) -> Callable:
+    """ Looks up a stage by its name in STAGES and additional_filter.
+        Parameters:
+            name (str): name of the stage
+        Returns: the stage function
+    """
+
+    if name in STAGES:
+        return STAGES[name]
+    stage = getattr(filter, name, None)
+    if not callable(stage):
+        raise ValueError('Unknown stage \'{}\'.'.format(name))
+    return stage
+
+
+class Node:
+    """ One stage of a compiled pipeline, identified by its stage, parameters and inputs.
+
+    Two nodes with the same signature compute the same value, so the graph only contains one of them.
+    """
+
+    def __init__(self, stage: str, params: Dict, inputs: Sequence['Node'], cached: bool = False,
+                 source: str = None):
+        """
+        @param stage: name of the stage (None for input nodes)
+        @param params: keyword parameters of the stage
+        @param inputs: nodes of the positional inputs of the stage
+        @param cached: run the stage through the stage_cache (only stages with one image input)
+        @param source: name of the input for input nodes
+        """
+        self.stage = stage
+        self.params = params
+        self.inputs = tuple(inputs)
+        self.cached = cached
+        self.source = source
+        self.signature = (stage, source, json.dumps(params, sort_keys=True), tuple(n.signature for n in self.inputs))
+
+
+class PipelineGraph:
+    """ A pipeline description compiled into a DAG of additional_filter stages, which is evaluated lazily.
+
+    The description has a dict of 'inputs' (name -> modality) and a dict of 'nodes'. Every node names its 'stage',
+    its positional 'inputs' (names of inputs or other nodes), its keyword 'params' and whether it is 'cached'.
+    Only the nodes needed for the requested outputs are computed, each of them once.
+    """
+
+    def __init__(self, description: Dict):
+        """
+        @param description: the pipeline description (see load_pipeline)
+        """
+        self.inputs = dict(description.get('inputs', {}))
+        self._definitions = dict(description['nodes'])
+        self._nodes = {}  # type: Dict[str, Node]
+        self._unique = {}  # type: Dict[Tuple, Node]
+        for name in self.inputs:
+            self._nodes[name] = self._share(Node(None, {}, (), source=name))
+        for name in self._definitions:
+            self._compile(name, ())
+
+    def _share(self, node: Node) -> Node:
+        """ Returns the node of the graph with the same signature, so that identical sub-graphs are shared. """
+        return self._unique.setdefault(node.signature, node)
+
+    def _compile(self, name: str, path: Tuple[str, ...]) -> Node:
+        if name in self._nodes:
+            return self._nodes[name]
+        if name in path:
+            raise ValueError('Cycle in the pipeline: {}'.format(' -> '.join(path + (name,))))
+        if name not in self._definitions:
+            raise ValueError('Unknown input or node \'{}\'.'.format(name))
+
+        definition = self._definitions[name]
+        if definition['stage'] != FIRST:
+            find_stage(definition['stage'])
+        inputs = [self._compile(input_name, path + (name,)) for input_name in definition.get('inputs', [])]
+        node = self._share(Node(definition['stage'], definition.get('params', {}), inputs,
+                                definition.get('cached', False)))
+        self._nodes[name] = node
+        return node
+
+    def __len__(self) -> int:
+        """ Number of distinct nodes (including the inputs). """
+        return len(self._unique)
+
+    def node(self, name: str) -> Node:
+        """ Gets a node by the name it has in the description.
+
+        @param name: name of an input or node
+        @return: the node (shared by all names with the same signature)
+        """
+        return self._nodes[name]
+
+    def required_inputs(self, outputs: Sequence[str]) -> List[str]:
+        """ Gets the inputs the outputs depend on (all inputs of 'first' nodes, because they may be needed).
+
+        @param outputs: names of the requested nodes
+        @return: names of the inputs in the order of the description
+        """
+        needed, stack = set(), [self._nodes[name] for name in outputs]
+        while stack:
+            node = stack.pop()
+            if node.signature not in needed:
+                needed.add(node.signature)
+                stack.extend(node.inputs)
+        return [name for name in self.inputs if self._nodes[name].signature in needed]
+
+    def evaluate(self, outputs: Sequence[str], inputs: Dict[str, Any]) -> Dict[str, Any]:
+        """ Computes the requested outputs and nothing else.
+
+        @param outputs: names of the requested nodes
+        @param inputs: values of the inputs, callables (like CaseLoader.__getitem__ bound to a modality) are only
+            called if the input is needed
+        @return: dict from output name to its value
+        """
+        values = {}  # type: Dict[Tuple, Any]
+
+        def value(node: Node) -> Any:
+            if node.signature in values:
+                return values[node.signature]
+            if node.source is not None:
+                result = inputs[node.source]
+                result = result() if callable(result) else result
+            elif node.stage == FIRST:
+                result = None
+                for input_node in node.inputs:
+                    result = value(input_node)
+                    if result is not None:
+                        break
+            else:
+                stage = find_stage(node.stage)
+                arguments = [value(input_node) for input_node in node.inputs]
+                if node.cached:
+                    result = stage_cache.cached(stage, *arguments, **node.params)
+                else:
+                    result = stage(*arguments, **node.params)
+            values[node.signature] = result
+            return result
+
+        return {name: value(self._nodes[name]) for name in outputs}
+
+
+def load_pipeline(path: str) -> PipelineGraph:
+    """ Reads a pipeline description from a .json or .yaml file and compiles it.
+        Parameters:
+            path (str): path of the description
+        Returns: the compiled graph
+    """
+
+    with open(path) as description_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError('PyYAML is needed to read {}, use a .json description instead.'.format(path))
+            description = yaml.safe_load(description_file)
+        else:
+            description = json.load(description_file)
+    return PipelineGraph(description)
+
+
+def run_case(graph: PipelineGraph, case_id: str, outputs: Sequence[str],
+             data_dir: str = pipeline.DATA_DIR) -> Dict[str, Any]:
+    """ Evaluates the outputs of a pipeline on one case, only the modalities they need are read.
+        Parameters:
+            graph (PipelineGraph): compiled pipeline whose inputs map to modalities
+            case_id (str): name of the case directory
+            outputs (Sequence[str]): names of the requested nodes
+            data_dir (str): directory containing the case directories
+        Returns: dict from output name to its value
+    """
+
+    names = graph.required_inputs(outputs)
+    with CaseLoader(case_id, [graph.inputs[name] for name in names], data_dir) as case:
+        inputs = {name: (lambda modality=graph.inputs[name]: case[modality]) for name in names}
+        return graph.evaluate(outputs, inputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates outputs of a pipeline description on an ISLES2015 case.')
+    parser.add_argument('description', help='pipeline description (.json or .yaml), e.g. pipeline.json')
+    parser.add_argument('case', help='case id')
+    parser.add_argument('--outputs', nargs='+', default=['metrics'], help='nodes to compute (default: metrics)')
+    parser.add_argument('--data-dir', default=pipeline.DATA_DIR)
+    args = parser.parse_args()
+
+    results = run_case(load_pipeline(args.description), args.case, args.outputs, args.data_dir)
+    for name, result in results.items():
+        if isinstance(result, sitk.Image):
+            sitk.WriteImage(result, name + '.nii.gz')
+            print('{}: written to {}.nii.gz'.format(name, name))
+        else:
+            print('{}: {}'.format(name, result))
@@ -0,0 +1,129 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict
+
+import SimpleITK as sitk
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# set MBV_TRACE to a file path to record every stage, e.g. MBV_TRACE=trace.jsonl python segmentation.py 01
+TRACE_PATH = os.environ.get('MBV_TRACE', '')
+ENABLED = TRACE_PATH != ''
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+_lock = threading.Lock()
+_trace_file = None
+_trace_pid = None
+
+
+def resident_memory() -> int:
+    """ Gets the resident memory of the process.
+        Returns: memory in bytes (the peak of the process, if /proc is not available)
+    """
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def describe(value: Any) -> Dict[str, Any]:
+    """ Describes an input or output of a stage for the trace.
+        Parameters:
+            value: image, list of seedpoints or anything else
+        Returns: dict with the voxel count (shape of arrays, length of lists) and the type
+    """
+
+    if isinstance(value, sitk.Image):
+        return {'voxels': value.GetNumberOfPixels(), 'dtype': value.GetPixelIDTypeAsString()}
+    if hasattr(value, 'shape'):
+        # numpy arrays, also numpy scalars and 0-d arrays, which have no len
+        return {'shape': list(value.shape), 'voxels': int(value.size), 'dtype': str(value.dtype)}
+    if isinstance(value, (list, tuple)):
+        return {'length': len(value), 'dtype': type(value).__name__}
+    return {'dtype': type(value).__name__}
+
+
+def _write(event: Dict):
+    global _trace_file, _trace_pid
+    with _lock:
+        # forked worker processes need their own file handle
+        if _trace_file is None or _trace_pid != os.getpid():
+            _trace_file = open(TRACE_PATH, 'a', buffering=1)
+            _trace_pid = os.getpid()
+        _trace_file.write(json.dumps(event) + '\n')
+
+
+@contextlib.contextmanager
+def _span(name: str, args: Dict):
+    memory_start = resident_memory()
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter()
+        args['memory_delta'] = resident_memory() - memory_start
+        # chrome trace event ('complete' event, times in microseconds)
+        _write({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args})
+
+
+def profiled(function: Callable) -> Callable:
+    """ Decorator recording time, input/output sizes and the memory delta of every call into the trace.
+    If MBV_TRACE is not set, the function is returned unchanged, so there is no overhead at all.
+        Parameters:
+            function (Callable): a pipeline stage
+        Returns: the wrapped function
+    """
+
+    if not ENABLED:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with _span(function.__qualname__, {'inputs': [describe(a) for a in args]}) as span_args:
+            result = function(*args, **kwargs)
+            span_args['output'] = describe(result)
+        return result
+    return wrapper
+
+
+def stage(name: str):
+    """ Context manager recording a block of code into the trace, does nothing if MBV_TRACE is not set.
+        Parameters:
+            name (str): name of the block in the trace
+        Returns: context manager
+    """
+
+    if not ENABLED:
+        return contextlib.nullcontext()
+    return _span(name, {})
+
+
+def write_chrome_trace(trace_path: str, output_path: str):
+    """ Converts a recorded trace (one event per line) into a json file for chrome://tracing or Perfetto.
+        Parameters:
+            trace_path (str): recorded trace
+            output_path (str): output path
+    """
+
+    with open(trace_path) as trace_file:
+        events = [json.loads(line) for line in trace_file if line.strip()]
+    with open(output_path, 'w') as output_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, output_file)
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 2, 'usage: python profiling.py trace.jsonl trace.json'
+    write_chrome_trace(sys.argv[1], sys.argv[2])
@@ -0,0 +1,155 @@
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import SimpleITK as sitk
+import numpy as np
+
+# region of interest as (index, size) in sitk (x, y, z) order
+Box = Tuple[Tuple[int, ...], Tuple[int, ...]]
+
+# default number of iterations of sitk.GradientAnisotropicDiffusionImageFilter (one voxel per iteration)
+DIFFUSION_ITERATIONS = 5
+
+
+def bounding_box(mask: np.ndarray) -> Optional[Tuple[slice, ...]]:
+    """ Computes the bounding box of all non-zero voxels without building a list of their indices.
+        Parameters:
+            mask (np.ndarray): any array
+        Returns: tuple of slices in the order of the array axes, None if the mask is empty
+    """
+
+    box = []
+    for axis in range(mask.ndim):
+        indices = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(indices) == 0:
+            return None
+        box.append(slice(int(indices[0]), int(indices[-1]) + 1))
+    return tuple(box)
+
+
+def chain_margin(parameters: Dict, diffusion_reach: int = DIFFUSION_ITERATIONS) -> int:
+    """ Computes how far the filters of the chain can look beyond the brain.
+    These are one voxel per diffusion iteration plus the kernel radii of opening, closing, dilation and hole filling.
+        Parameters:
+            parameters (Dict): parameters like pipeline.FLAIR_PARAMETERS
+            diffusion_reach (int): how far the smoothing looks (see additional_filter.diffusion_reach)
+        Returns: margin in voxels
+    """
+
+    closing_radius = parameters['closing_radius']
+    if not isinstance(closing_radius, int):
+        closing_radius = max(closing_radius)
+    return diffusion_reach + 2 * 1 + 2 * closing_radius + int(parameters['dilate']) + parameters['hole_radius']
+
+
+def brain_box(image: sitk.Image, margin: int) -> Optional[Box]:
+    """ Computes the bounding box of the brain (every voxel != 0) with a margin.
+        Parameters:
+            image (sitk.Image): brain-MRT image
+            margin (int): margin in voxels on every side, clipped at the image border
+        Returns: the box, None if the image is empty
+    """
+
+    box = bounding_box(sitk.GetArrayViewFromImage(image) != 0)
+    if box is None:
+        return None
+    size = image.GetSize()
+    # numpy (z, y, x) to sitk (x, y, z) order
+    start = [max(s.start - margin, 0) for s in box[::-1]]
+    stop = [min(s.stop + margin, n) for s, n in zip(box[::-1], size)]
+    return tuple(start), tuple(b - a for a, b in zip(start, stop))
+
+
+def crop(image: sitk.Image, box: Box) -> sitk.Image:
+    """ Cuts the box out of the image, the physical position of the voxels stays the same.
+        Parameters:
+            image (sitk.Image): image
+            box (Box): box from brain_box
+        Returns: the cropped image
+    """
+
+    index, size = box
+    return sitk.RegionOfInterest(image, size, index)
+
+
+def paste(cropped: sitk.Image, reference: sitk.Image, box: Box) -> sitk.Image:
+    """ Puts a cropped result back into an empty image with the full size and geometry.
+        Parameters:
+            cropped (sitk.Image): result computed on crop(..., box)
+            reference (sitk.Image): image with the full size and geometry
+            box (Box): box used for cropping
+        Returns: the full-size image
+    """
+
+    full = sitk.Image(reference.GetSize(), cropped.GetPixelID())
+    full.CopyInformation(reference)
+    index, size = box
+    return sitk.Paste(full, cropped, size, [0] * len(size), index)
+
+
+def component_boxes(mask: sitk.Image, factor: int, margin: int, count: int, size: Sequence[int]) -> List[Box]:
+    """ Computes the boxes around the biggest connected components of a downsampled mask in full resolution.
+        Parameters:
+            mask (sitk.Image): binary mask, downsampled by factor
+            factor (int): downsampling factor
+            margin (int): margin in full resolution voxels on every side
+            count (int): maximum number of components
+            size (Sequence[int]): size of the full resolution image
+        Returns: boxes of the components, biggest first
+    """
+
+    labels = sitk.RelabelComponent(sitk.ConnectedComponent(mask), sortByObjectSize=True)
+    shape_stats = sitk.LabelShapeStatisticsImageFilter()
+    shape_stats.Execute(labels)
+
+    boxes = []
+    for label in shape_stats.GetLabels()[:count]:
+        bounding_box = shape_stats.GetBoundingBox(label)
+        dimension = len(bounding_box) // 2
+        start = [max(i * factor - margin, 0) for i in bounding_box[:dimension]]
+        stop = [min((i + s) * factor + margin, n) for i, s, n in zip(bounding_box[:dimension],
+                                                                    bounding_box[dimension:], size)]
+        boxes.append((tuple(start), tuple(b - a for a, b in zip(start, stop))))
+    return boxes
+
+
+def seed_box(box: Box, image_size: Sequence[int]) -> Optional[Box]:
+    """ Computes the box the seedpoints of a box come from.
+    additional_filter.seedpoints returns numpy (z, y, x) indices, which sitk reads as (x, y, z), so the region growing
+    in a box starts from the bright voxels of the transposed box (reversed index and size), not of the box itself.
+        Parameters:
+            box (Box): box the region growing runs on
+            image_size (Sequence[int]): size of the full image
+        Returns: the transposed box, clipped at the image border (None, if nothing of it is inside the image)
+    """
+
+    index, size = box
+    start = [min(i, n) for i, n in zip(index[::-1], image_size)]
+    stop = [min(i + s, n) for i, s, n in zip(index[::-1], size[::-1], image_size)]
+    if any(b <= a for a, b in zip(start, stop)):
+        return None
+    return tuple(start), tuple(b - a for a, b in zip(start, stop))
+
+
+def shift_seeds(seeds: Union[np.ndarray, List[List[int]]], box: Box, source_box: Box = None) -> np.ndarray:
+    """ Converts seedpoints found on a cropped image into the seedpoints of the full image.
+    additional_filter.seedpoints returns numpy (z, y, x) indices, which sitk reads as (x, y, z). This is kept as it is,
+    so the region growing on the cropped image starts from the same voxels as on the full image, if the seedpoints
+    are found on the seed_box of the box (on the box itself, this only holds if there are no bright voxels outside
+    of it, like for brain_box).
+    Seedpoints which are outside of the box are dropped (there is only background).
+    Only for the seedpoints found by intensity, markers set manually are already indices of the cropped image.
+        Parameters:
+            seeds (np.ndarray or List[List[int]]): seedpoints from additional_filter.seedpoints on the cropped image
+            box (Box): box the region growing runs on
+            source_box (Box): box of the image the seedpoints were found on (default: box)
+        Returns: seedpoints for the region growing on the cropped image
+    """
+
+    index, size = box
+    source_index = (source_box or box)[0]
+    if len(seeds) == 0:
+        return np.empty((0, len(index)), dtype=np.int32)
+    # numpy index in the full image, read as sitk index and moved into the box
+    shifted = np.asarray(seeds) + np.asarray(source_index[::-1]) - np.asarray(index)
+    inside = np.all((shifted >= 0) & (shifted < np.asarray(size)), axis=1)
+    return shifted[inside].astype(np.int32)
@@ -1,131 +1,82 @@
-import SimpleITK as sitk
 import sys
-import image_viewing as vis
-import numpy as np
-import matplotlib.pyplot as plt
-from typing import List
+import pipeline
 import additional_filter as filter
+import array_backend
+import thread_budget
+from case_loader import CaseLoader
 
 
 assert len(sys.argv) > 1, 'No input image specified!'
-# load example image from argv
-path = 'ISLES2015_Train/'+sys.argv[1]+'/VSD.Brain.'+sys.argv[1]+'.O.MR_Flair_reg.nii.gz'
-input_image = sitk.ReadImage(path)
+# with --backend=auto, --backend=sitk or --backend=numpy the chain runs on arrays (see pipeline.segment_arrays),
+# on the whole image and not with manual seedpoints
+backend = next((arg.split('=', 1)[1] for arg in sys.argv[2:] if arg.startswith('--backend=')), None)
+assert backend is None or backend in array_backend.CHOICES, \
+    'Unknown backend \'{}\'. Choose from {}.'.format(backend, array_backend.CHOICES)
+assert backend is None or not {'--roi', '--pyramid'} & set(sys.argv[2:]), \
+    '--backend runs on the whole image, it cannot be combined with --roi or --pyramid'
+# with --headless no viewer is shown and Qt and matplotlib are never imported (e.g. on a server)
+headless = '--headless' in sys.argv[2:]
+if not headless:
+    import image_viewing as vis
+# a single interactive case: every filter may use all cores (the speculative mode runs two chains at a time)
+thread_budget.ThreadBudget(thread_budget.FILTER,
+                           processes_per_worker=2 if '--speculative' in sys.argv[2:] else 1).apply()
+# load example images from argv (Flair, DWI and the given segmentation are read in parallel)
+case = CaseLoader(sys.argv[1], (pipeline.FLAIR, pipeline.DWI, pipeline.REFERENCE))
+input_image = case[pipeline.FLAIR]
 #vis.show_image(input_image, 'input', False)
 
-# normalise image to [0,500] and remove measurement errors below the 5th and above the 99th percentile
-normalised_image = filter.normalise(input_image)
-#vis.show_image(normalised_image, 'Flair normalised', False)
-
-# image smoothing with edge preservation
-grad_image = filter.gradient(normalised_image)
-#vis.show_image(grad_image, 'Flair grad', False)
-
-# get seedpoints
-seeds = filter.seedpoints(grad_image)
-
-# compute thresh image with lower = 200, upper = 500 for all seedpoints
-thresh_image = filter.threshold(grad_image, seeds)
-#vis.show_image(thresh_image, 'thresh', False)
-#vis.show_image_with_mask(normalised_image, thresh_image)
-
-# opening and closing on the image
-open_image = filter.opening(thresh_image)
-close_image = filter.closing(open_image)
-dilate_image = filter.dilate(close_image)
-hole_image = filter.hole_filling(dilate_image)
-#vis.show_image(hole_image, 'Flair opening&closing&dilate&hole', False)
-
-# label the connected components
-label_image = filter.labeling(hole_image)
-
-
-# choose the biggest connected component
-cast = sitk.CastImageFilter()
-cast.SetOutputPixelType(sitk.sitkInt32)
-relabel_image = filter.connected_component(cast.Execute(label_image))
+# with --speculative the DWI chain already runs next to the Flair chain (not possible with manual seedpoints)
+speculative = '--speculative' in sys.argv[2:] and '--manually' not in sys.argv[2:]
+# with --roi the chain only runs on the bounding box of the brain,
+# with --pyramid it only runs around lesion candidates found on the image downsampled by 2
+options = {'roi': '--roi' in sys.argv[2:], 'pyramid': 2 if '--pyramid' in sys.argv[2:] else None}
+if '--manually' not in sys.argv[2:]:
+    options['backend'] = backend
+if speculative:
+    modality, normalised_image, relabel_image = pipeline.segment_speculative(input_image, case[pipeline.DWI],
+                                                                             **options)
+else:
+    # normalise, smooth, threshold, opening&closing&dilate&hole filling and choose the biggest connected component
+    modality = pipeline.FLAIR
+    normalised_image, relabel_image = pipeline.segment_flair(input_image, **options)
 # test, if there is any label selected and if it is big enough.
-if relabel_image is not None:
-    sitk.WriteImage(relabel_image, 'segmentation.nii.gz')
-    #vis.show_image(relabel_image, 'Flair segmentation', True)
-
-    # get changes made by key-actions
-    relabel_image = sitk.ReadImage('segmentation.nii.gz')
+if modality == pipeline.FLAIR and relabel_image is not None:
+    #relabel_image = vis.show_and_return_image(relabel_image, 'Flair segmentation')
 
     # show the input_image with the segmentation
-    vis.show_image_with_mask(normalised_image, relabel_image, 'Flair segmentation with image', 'b', False)
+    if not headless:
+        vis.show_image_with_mask(normalised_image, relabel_image, 'Flair segmentation with image', 'b', False)
 else: # use DWI image
-    # load example image from argv
-    path = 'ISLES2015_Train/' + sys.argv[1] + '/VSD.Brain.' + sys.argv[1] + '.O.MR_DWI_reg.nii.gz'
-    input_image = sitk.ReadImage(path)
-
-    # normalise image to [0,500] and remove measurement errors between (min, min+5) and (max-5,max)
-    normalised_image = filter.normalise(input_image)
-    #vis.show_image(normalised_image, 'DWI normalised', False)
-
-    # image smoothing with edge preservation
-    grad_image = filter.gradient(normalised_image)
-    #vis.show_image(grad_image, 'grad', False)
-
-    # get seedpoints
-    seeds = filter.seedpoints(grad_image)
+    # use the DWI image, which has been loaded in the meantime
+    input_image = case[pipeline.DWI]
 
-    # compute thresh image with lower = 200, upper = 500 for all seedpoints
-    thresh_filter = sitk.ConnectedThresholdImageFilter()
-    thresh_filter.SetSeedList(seeds)
-    thresh_filter.SetLower(470)
-    thresh_filter.SetUpper(500)
-    thresh_image = thresh_filter.Execute(grad_image)
-    #vis.show_image(thresh_image, 'DWI thresh', True)
+    # same chain with lower threshold and without dilation
+    if not speculative:
+        normalised_image, relabel_image = pipeline.segment_dwi(input_image, **options)
 
-    # opening and closing on the image
-    open_image = filter.opening(thresh_image)
-    close_image = filter.closing(open_image)
-    hole_image = filter.hole_filling(close_image)
-    #vis.show_image(close_image, 'DWI opening&closing', False)
+    if not headless:
+        # show the segmentation and get changes made by key-actions
+        relabel_image = vis.show_and_return_image(relabel_image, 'DWI segmentation')
 
-    # label the connected components
-    label_image = filter.labeling(hole_image)
-
-    # choose the biggest connected component
-    cast = sitk.CastImageFilter()
-    cast.SetOutputPixelType(sitk.sitkInt32)
-    relabel_image = filter.connected_component(cast.Execute(label_image))
-    sitk.WriteImage(relabel_image, 'segmentation.nii.gz')
-    vis.show_image(relabel_image, 'DWI segmentation', True)
-
-    # get changes made by key-actions
-    relabel_image = sitk.ReadImage('segmentation.nii.gz')
-
-    # show the input_image with the segmentation
-    vis.show_image_with_mask(normalised_image, relabel_image, 'DWI segmentation with image', 'b', False)
+        # show the input_image with the segmentation
+        vis.show_image_with_mask(normalised_image, relabel_image, 'DWI segmentation with image', 'b', False)
 
+# the segmentation is only written once, after all changes
+filter.save_segmentation(relabel_image)
 
 # load given segmentation
-path = 'ISLES2015_Train/'+sys.argv[1]+'/VSD.Brain.'+sys.argv[1]+'.O.OT_reg.nii.gz'
-seg_image = sitk.ReadImage(path)
-# cast segmentation
-cast = sitk.CastImageFilter()
-cast.SetOutputPixelType(sitk.sitkInt32)
-casted_seg_image = cast.Execute(seg_image)
-
-# calculate Dice from our segmentation and given segmentation
-measures = sitk.LabelOverlapMeasuresImageFilter()
-measures.Execute(relabel_image, casted_seg_image)
-
-hausdorff_Distance = sitk.HausdorffDistanceImageFilter()
-hausdorff_Distance.Execute(relabel_image, casted_seg_image)
-
-print("Dice: ", measures.GetDiceCoefficient())
-print("Jaccard: ", measures.GetJaccardCoefficient())
-print("Hausdorff: ", hausdorff_Distance.GetHausdorffDistance())
-
-#calculate the volume of the segmentation
-shape_stats = sitk.LabelShapeStatisticsImageFilter()
-shape_stats.Execute(relabel_image)
-
-for i in shape_stats.GetLabels():
-    size = shape_stats.GetPhysicalSize(i)
-print("Volume: ", size, "mm^3")
-
-vis.show_image_with_mask(input_image, seg_image, 'reference segmentation with image', 'b', False)
+seg_image = case[pipeline.REFERENCE]
+
+# calculate Dice, Jaccard, Hausdorff and the volume from our segmentation and given segmentation
+results = pipeline.evaluate(relabel_image, seg_image)
+print("Dice: ", results['Dice'])
+print("Jaccard: ", results['Jaccard'])
+print("Sensitivity: ", results['Sensitivity'])
+print("Precision: ", results['Precision'])
+print("Hausdorff: ", results['Hausdorff'])
+print("HD95: ", results['HD95'])
+print("Volume: ", results['Volume'], "mm^3")
+
+if not headless:
+    vis.show_image_with_mask(input_image, seg_image, 'reference segmentation with image', 'b', False)
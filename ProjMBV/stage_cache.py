@@ -0,0 +1,145 @@
+import hashlib
+import os
+import tempfile
+from typing import Callable, Optional
+
+import SimpleITK as sitk
+import numpy as np
+
+# the cache can be moved or switched off (MBV_STAGE_CACHE=0) by environment variables
+CACHE_DIR = os.environ.get('MBV_CACHE_DIR', '.stage_cache')
+MAX_CACHE_SIZE = int(os.environ.get('MBV_CACHE_SIZE', 2 * 1024 ** 3))  # bytes
+ENABLED = os.environ.get('MBV_STAGE_CACHE', '1') != '0'
+
+# uncompressed MetaImage, so that a cache hit costs nothing but reading the raw voxels
+_SUFFIX = '.mha'
+_TMP_PREFIX = '.tmp-'
+
+
+def image_hash(image: sitk.Image) -> str:
+    """ Computes a hash over the voxels and the geometry of an image.
+        Parameters:
+            image (sitk.Image): any image
+        Returns: hex digest
+    """
+
+    digest = hashlib.sha1()
+    digest.update(repr((image.GetPixelIDValue(), image.GetNumberOfComponentsPerPixel(), image.GetSize(),
+                        image.GetSpacing(), image.GetOrigin(), image.GetDirection())).encode())
+    digest.update(sitk.GetArrayViewFromImage(image).reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+class StageCache:
+    """ On-disk cache for the results of pipeline stages.
+
+    Results are stored under a key built from the stage name, its parameters and the hash of the input image.
+    If the cache grows bigger than max_size, the least recently used results are deleted.
+    Attention: the key does not contain the code of the stage, clear the cache after changing a filter!
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_size: int = MAX_CACHE_SIZE):
+        """
+        @param directory: directory for the cached images (created on the first write)
+        @param max_size: maximum size of all cached images in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, stage: str, image: sitk.Image, **params) -> str:
+        """ Builds the key of a stage result.
+
+        @param stage: name of the stage
+        @param image: input image of the stage
+        @param params: parameters of the stage
+        @return: the key
+        """
+        digest = hashlib.sha1(image_hash(image).encode())
+        digest.update(repr(sorted(params.items())).encode())
+        return stage + '-' + digest.hexdigest()
+
+    def get(self, key: str) -> Optional[sitk.Image]:
+        """ Loads a cached result and marks it as recently used.
+
+        @param key: key from self.key
+        @return: the cached image or None if there is no result for the key
+        """
+        path = os.path.join(self.directory, key + _SUFFIX)
+        try:
+            os.utime(path)
+            return sitk.ReadImage(path)
+        except (OSError, RuntimeError):
+            # missing, or deleted by the eviction of another process in the meantime
+            return None
+
+    def put(self, key: str, image: sitk.Image):
+        """ Stores a result and evicts old results if the cache is too big.
+
+        @param key: key from self.key
+        @param image: the result to store
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first, so that parallel runs never read half written images
+        handle, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, suffix=_SUFFIX, dir=self.directory)
+        os.close(handle)
+        try:
+            sitk.WriteImage(image, tmp_path, useCompression=False)
+            os.replace(tmp_path, os.path.join(self.directory, key + _SUFFIX))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """ Deletes the least recently used results until the cache is smaller than max_size.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX) and not entry.name.startswith(_TMP_PREFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def run(self, stage: Callable[..., sitk.Image], image: sitk.Image, **params) -> sitk.Image:
+        """ Returns the cached result of stage(image, **params) or computes and stores it.
+
+        @param stage: a filter from additional_filter returning one image
+        @param image: input image of the stage
+        @param params: keyword parameters of the stage
+        @return: the result of the stage
+        """
+        key = self.key(stage.__name__, image, **params)
+        result = self.get(key)
+        if result is None:
+            result = stage(image, **params)
+            self.put(key, result)
+        return result
+
+
+_default_cache = StageCache()
+
+
+def cached(stage: Callable[..., sitk.Image], image: sitk.Image, **params) -> sitk.Image:
+    """ Runs a stage through the default cache, or directly if the cache is switched off.
+        Parameters:
+            stage (Callable): a filter from additional_filter returning one image
+            image (sitk.Image): input image of the stage
+            params: keyword parameters of the stage
+        Returns: the result of the stage
+    """
+
+    if not ENABLED:
+        return stage(image, **params)
+    return _default_cache.run(stage, image, **params)
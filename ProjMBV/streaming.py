@@ -0,0 +1,172 @@
+from typing import Callable, Iterator, List, Sequence, Union
+
+import SimpleITK as sitk
+import numpy as np
+
+import additional_filter as filter
+
+# bytes per voxel a filter needs at most: the diffusion needs input, output and its float buffers,
+# the intensity window an int16 input and output, the histogram an int16 slab and its intp offsets,
+# the binary morphology needs input, output and one temporary uint8 image
+WORKING_BYTES = {'gradient': 16, 'intensity_window': 4, 'percentiles': 10}
+MORPHOLOGY_BYTES = 4
+
+
+def halo(stage: str, **params) -> int:
+    """ Computes how many slices a filter looks beyond a slab, so that the inner part of the slab is exact.
+        Parameters:
+            stage (str): name of the filter in additional_filter
+            params: parameters of the filter (radius, iterations, mode, engine)
+        Returns: halo in slices
+    """
+
+    if stage == 'gradient':
+        return filter.diffusion_reach(**params)
+    if stage == 'intensity_window':
+        # voxel-wise
+        return 0
+    if stage in ('opening', 'closing'):
+        radius = params.get('radius', 1 if stage == 'opening' else 2)
+        # erosion and dilation
+        return 2 * (radius if isinstance(radius, int) else radius[2])
+    if stage in ('dilate', 'erode'):
+        return 1
+    if stage == 'hole_filling':
+        if params.get('engine') == filter.FILL:
+            raise ValueError('The 3D fill of hole_filling is not local and can not be run slab-wise.')
+        # FILL_SLICES only looks at one axial slice, which is always complete in a z-slab
+        return params.get('radius', 2) * params.get('iterations', 20)
+    raise ValueError('{} is not a local filter and can not be run slab-wise.'.format(stage))
+
+
+def slab_depth(slice_voxels: int, slab_halo: int, memory_budget: int, bytes_per_voxel: int = MORPHOLOGY_BYTES) -> int:
+    """ Computes how many slices one slab can have without the halo.
+    A slab has at least as many slices as its halo, otherwise most of the work would be done on the halo
+    (so a too small budget is exceeded rather than making the filter very slow).
+        Parameters:
+            slice_voxels (int): voxels of one z-slice
+            slab_halo (int): halo on each side of the slab
+            memory_budget (int): bytes one slab may use
+            bytes_per_voxel (int): bytes the filter needs per voxel
+        Returns: number of slices
+    """
+
+    return max(memory_budget // (slice_voxels * bytes_per_voxel) - 2 * slab_halo, slab_halo, 1)
+
+
+class _SlabReader:
+    """ Reads z-slabs of an image, from memory or slab by slab from its file. """
+
+    def __init__(self, source: Union[sitk.Image, str]):
+        """
+        @param source: image or path of it
+        """
+        if isinstance(source, str):
+            self.reader = sitk.ImageFileReader()
+            self.reader.SetFileName(source)
+            self.reader.ReadImageInformation()
+            information = self.reader
+        else:
+            self.reader = None
+            information = source
+        self.source = source
+        self.size = information.GetSize()
+        self.geometry = information.GetSpacing(), information.GetOrigin(), information.GetDirection()
+
+    def read(self, lower: int, upper: int) -> sitk.Image:
+        """ Gets the slices lower to upper (exclusive). """
+        if self.reader is None:
+            return self.source[:, :, lower:upper]
+        self.reader.SetExtractIndex([0, 0, lower])
+        self.reader.SetExtractSize([self.size[0], self.size[1], upper - lower])
+        return self.reader.Execute()
+
+    def slabs(self, depth: int) -> Iterator[sitk.Image]:
+        """ Gets the image in slabs of depth slices. """
+        for start in range(0, self.size[2], depth):
+            yield self.read(start, min(start + depth, self.size[2]))
+
+
+def run_slabwise(stage: Callable[..., sitk.Image], source: Union[sitk.Image, str], memory_budget: int,
+                 transform: Callable[[sitk.Image], sitk.Image] = None, **params) -> sitk.Image:
+    """ Runs a local filter on overlapping z-slabs and stitches the inner parts of the results.
+    Only one slab (with its halo) is in the filter at a time, so the memory the filter needs for its working
+    buffers is bounded by memory_budget. The inner part of every slab is pasted straight into the output image,
+    which is the only full-size image allocated here. If source is a file path, the input is read slab by slab and
+    is never in memory as a whole.
+        Parameters:
+            stage (Callable): local filter from additional_filter (see halo)
+            source (sitk.Image or str): input image or path of it
+            memory_budget (int): bytes one slab may use
+            transform (Callable): voxel-wise filter applied to every slab before stage, e.g. the intensity window
+                of normalise (see slab_percentiles)
+            params: parameters of the filter
+        Returns: the filtered image with the geometry of the input
+    """
+
+    slab_reader = _SlabReader(source)
+    size = slab_reader.size
+    slab_halo = halo(stage.__name__, **params)
+    depth = slab_depth(size[0] * size[1], slab_halo, memory_budget,
+                       WORKING_BYTES.get(stage.__name__, MORPHOLOGY_BYTES))
+
+    output = None
+    for start in range(0, size[2], depth):
+        stop = min(start + depth, size[2])
+        lower, upper = max(start - slab_halo, 0), min(stop + slab_halo, size[2])
+        slab = slab_reader.read(lower, upper)
+        if transform is not None:
+            slab = transform(slab)
+
+        result = stage(slab, **params)
+        if output is None:
+            output = sitk.Image(size, result.GetPixelID())
+            spacing, origin, direction = slab_reader.geometry
+            output.SetSpacing(spacing)
+            output.SetOrigin(origin)
+            output.SetDirection(direction)
+        # pasted in place, the output is not copied
+        output[:, :, start:stop] = result[:, :, start - lower:stop - lower]
+        del result, slab
+    return output
+
+
+def slab_percentiles(source: Union[sitk.Image, str], qs: Sequence[float], memory_budget: int) -> List[float]:
+    """ additional_filter.percentiles of an integer image, counted slab by slab (see run_slabwise).
+        Parameters:
+            source (sitk.Image or str): input image or path of it
+            qs (Sequence[float]): percentiles between 0 and 100
+            memory_budget (int): bytes one slab may use
+        Returns: the percentiles in the order of qs
+    """
+
+    slab_reader = _SlabReader(source)
+    depth = slab_depth(slab_reader.size[0] * slab_reader.size[1], 0, memory_budget, WORKING_BYTES['percentiles'])
+    # the range of values first, then the histogram
+    lowest, highest = None, None
+    for slab in slab_reader.slabs(depth):
+        array = sitk.GetArrayViewFromImage(slab)
+        if not np.issubdtype(array.dtype, np.integer):
+            raise ValueError('Only the percentiles of integer images can be counted slab-wise.')
+        lowest = int(array.min()) if lowest is None else min(lowest, int(array.min()))
+        highest = int(array.max()) if highest is None else max(highest, int(array.max()))
+        del array
+    histogram = np.zeros(highest - lowest + 1, dtype=np.intp)
+    for slab in slab_reader.slabs(depth):
+        array = sitk.GetArrayViewFromImage(slab)
+        histogram += np.bincount(np.subtract(array.ravel(), lowest, dtype=np.intp), minlength=histogram.size)
+        del array
+    return filter.histogram_percentiles(histogram, lowest, qs)
+
+
+def slab_gradient(image: sitk.Image, memory_budget: int, **diffusion) -> sitk.Image:
+    """ additional_filter.gradient run slab-wise (see run_slabwise).
+    The diffusion scales with the mean gradient of each slab, so the result differs slightly from the whole image.
+        Parameters:
+            image (sitk.Image): brain-MRT image
+            memory_budget (int): bytes one slab may use
+            diffusion: parameters of additional_filter.gradient (iterations, tolerance, threads, mode)
+        Returns: smoothed sitk.Image
+    """
+
+    return run_slabwise(filter.gradient, image, memory_budget, **diffusion)
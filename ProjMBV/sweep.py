@@ -0,0 +1,144 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Sequence
+
+import evaluation
+import pipeline
+import thread_budget
+import volume_cache
+
+# parameters used by pipeline.region_growing, all others are used by pipeline.postprocess
+REGION_GROWING_PARAMETERS = ('seed_cutoff', 'lower', 'upper')
+
+
+def parameter_grid(grid: Dict[str, Sequence], defaults: Dict = pipeline.FLAIR_PARAMETERS) -> List[Dict]:
+    """ Builds every combination of the given parameter values.
+        Parameters:
+            grid (Dict[str, Sequence]): values to try per parameter, e.g. {'lower': [480, 490]}
+            defaults (Dict): values of the parameters not contained in grid
+        Returns: list of complete parameter dicts
+    """
+
+    unknown = set(grid) - set(defaults)
+    if unknown:
+        raise ValueError('Unknown parameters {}. Choose from {}.'.format(sorted(unknown), sorted(defaults)))
+
+    names = sorted(grid)
+    combinations = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        parameters = dict(defaults)
+        parameters.update(zip(names, values))
+        combinations.append(parameters)
+    return combinations
+
+
+def sweep_case(case_id: str, combinations: List[Dict], modality: str = pipeline.FLAIR,
+               data_dir: str = pipeline.DATA_DIR) -> List[Dict]:
+    """ Evaluates every parameter combination on one case.
+    The normalised and smoothed image is computed once for all combinations and every region growing result
+    is shared by all combinations which only differ in the later stages.
+        Parameters:
+            case_id (str): name of the case directory
+            combinations (List[Dict]): parameter dicts from parameter_grid
+            modality (str): pipeline.FLAIR or pipeline.DWI
+            data_dir (str): directory containing the case directories
+        Returns: one row per combination with the parameters and evaluation.METRICS
+    """
+
+    _, grad_image = pipeline.preprocess(volume_cache.read_image(pipeline.case_path(case_id, modality, data_dir)))
+    reference = volume_cache.read_image(pipeline.case_path(case_id, pipeline.REFERENCE, data_dir))
+
+    rows = []
+    thresh_images = {}
+    for parameters in combinations:
+        key = tuple(parameters[name] for name in REGION_GROWING_PARAMETERS)
+        if key not in thresh_images:
+            thresh_images[key] = pipeline.region_growing(grad_image, *key)
+        segmentation = pipeline.postprocess(thresh_images[key], **{name: value for name, value in parameters.items()
+                                                                   if name not in REGION_GROWING_PARAMETERS})
+        row = {'Case': case_id}
+        row.update(parameters)
+        row.update(evaluation.evaluate_pair(segmentation, reference))
+        rows.append(row)
+    return rows
+
+
+def run_sweep(case_ids: Sequence[str], combinations: List[Dict], modality: str = pipeline.FLAIR,
+              data_dir: str = pipeline.DATA_DIR, workers: int = None) -> List[Dict]:
+    """ Runs sweep_case for every case on a process pool.
+        Parameters:
+            case_ids (Sequence[str]): cases to use
+            combinations (List[Dict]): parameter dicts from parameter_grid
+            modality (str): pipeline.FLAIR or pipeline.DWI
+            data_dir (str): directory containing the case directories
+            workers (int): number of processes, defaults to the number of cores
+        Returns: all rows of all cases
+    """
+
+    n = len(case_ids)
+    # one case per process, the filters share the cores instead of starting one thread per core each
+    budget = thread_budget.ThreadBudget(thread_budget.PROCESS, workers)
+    with ProcessPoolExecutor(max_workers=min(budget.workers, n), initializer=thread_budget.apply,
+                             initargs=(budget,)) as executor:
+        results = executor.map(sweep_case, case_ids, [combinations] * n, [modality] * n, [data_dir] * n)
+        return [row for rows in results for row in rows]
+
+
+def mean_dice(rows: List[Dict], combinations: List[Dict]) -> List[Dict]:
+    """ Averages the Dice of every combination over all cases (failed segmentations count as 0).
+        Parameters:
+            rows (List[Dict]): rows from run_sweep
+            combinations (List[Dict]): parameter dicts from parameter_grid
+        Returns: the combinations with their mean Dice, best first
+    """
+
+    summary = []
+    for parameters in combinations:
+        dices = [0.0 if math.isnan(row['Dice']) else row['Dice'] for row in rows
+                 if all(row[name] == value for name, value in parameters.items())]
+        summary.append(dict(parameters, Dice=statistics.mean(dices)))
+    return sorted(summary, key=lambda row: row['Dice'], reverse=True)
+
+
+def parse_grid(arguments: Sequence[str]) -> Dict[str, List]:
+    """ Parses grid arguments of the form name=value1,value2 (values as json, e.g. closing_radius=[1,1,1],2).
+        Parameters:
+            arguments (Sequence[str]): command line arguments
+        Returns: the grid for parameter_grid
+    """
+
+    grid = {}
+    for argument in arguments:
+        name, values = argument.split('=', 1)
+        values = json.loads('[' + values + ']')
+        grid[name] = [tuple(v) if isinstance(v, list) else v for v in values]
+    return grid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates a grid of pipeline parameters on the ISLES2015 cases.')
+    parser.add_argument('grid', nargs='+', help='parameter values, e.g. lower=480,490 minimum_size=100,200')
+    parser.add_argument('--cases', nargs='+', help='case ids to use (default: all cases in the data directory)')
+    parser.add_argument('--modality', default=pipeline.FLAIR, choices=[pipeline.FLAIR, pipeline.DWI])
+    parser.add_argument('--data-dir', default=pipeline.DATA_DIR)
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: number of cores)')
+    parser.add_argument('--output', default='sweep.csv', help='path of the table with all results')
+    args = parser.parse_args()
+
+    defaults = pipeline.FLAIR_PARAMETERS if args.modality == pipeline.FLAIR else pipeline.DWI_PARAMETERS
+    combinations = parameter_grid(parse_grid(args.grid), defaults)
+    rows = run_sweep(args.cases or pipeline.discover_cases(args.data_dir), combinations, args.modality,
+                     args.data_dir, args.workers)
+
+    with open(args.output, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=['Case'] + sorted(defaults) + evaluation.METRICS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    for row in mean_dice(rows, combinations):
+        print('Dice {:.3f}: {}'.format(row.pop('Dice'), row))
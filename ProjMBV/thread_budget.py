@@ -0,0 +1,101 @@
+import os
+from typing import Dict, List, Optional
+
+import SimpleITK as sitk
+
+# process-level parallelism: many cases side by side (cohorts), each filter gets its share of the cores
+PROCESS = 'process'
+# filter-level parallelism: one case at a time (interactive), every filter may use all cores
+FILTER = 'filter'
+POLICIES = (PROCESS, FILTER)
+
+# the budget of this process, set by ThreadBudget.apply
+_active = None  # type: Optional[ThreadBudget]
+
+
+class ThreadBudget:
+    """ Splits the cores between worker processes and the threads of the SimpleITK filters, so that several cases
+    running side by side do not start one thread per core each.
+
+    apply sets the global default number of threads of SimpleITK, single stages can get another number of threads
+    (see configure).
+    """
+
+    def __init__(self, policy: str = FILTER, workers: int = None, cores: int = None,
+                 processes_per_worker: int = 1, stage_threads: Dict[str, int] = None):
+        """
+        @param policy: PROCESS or FILTER
+        @param workers: number of worker processes for PROCESS (default: one per core), FILTER always uses one
+        @param cores: number of cores to share (default: all cores of the machine)
+        @param processes_per_worker: processes each worker starts itself, e.g. 2 for the speculative mode
+        @param stage_threads: number of threads for single stages (name of the function in additional_filter),
+            which differ from the share of the policy
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy \'{}\'. Choose from {}.'.format(policy, POLICIES))
+        self.policy = policy
+        self.cores = cores or os.cpu_count() or 1
+        self.workers = min(workers or self.cores, self.cores) if policy == PROCESS else 1
+        self.threads = max(self.cores // (self.workers * processes_per_worker), 1)
+        self.stage_threads = dict(stage_threads or {})
+
+    def threads_for(self, stage: str) -> int:
+        """ Gets the number of threads of a stage.
+
+        @param stage: name of the function in additional_filter
+        @return: number of threads
+        """
+        return self.stage_threads.get(stage, self.threads)
+
+    def apply(self):
+        """ Sets the global default number of threads of SimpleITK and makes this the budget of the process.
+        Call it in every worker process (e.g. as initializer of the pool), the default is not inherited on spawn.
+        """
+        global _active
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.threads)
+        _active = self
+
+    def __repr__(self) -> str:
+        return '{} policy: {} worker(s) x {} thread(s) per filter'.format(self.policy, self.workers, self.threads)
+
+
+def apply(budget: ThreadBudget):
+    """ Applies a budget, usable as initializer of a process pool.
+        Parameters:
+            budget (ThreadBudget): budget of the worker
+    """
+
+    budget.apply()
+
+
+def configure(process_object: sitk.ProcessObject, stage: str) -> sitk.ProcessObject:
+    """ Sets the number of threads of a filter, if the budget of the process has its own number for the stage.
+    All other filters use the global default set by ThreadBudget.apply.
+        Parameters:
+            process_object (sitk.ProcessObject): filter object
+            stage (str): name of the function in additional_filter
+        Returns: the filter object
+    """
+
+    if _active is not None and stage in _active.stage_threads:
+        process_object.SetNumberOfThreads(_active.stage_threads[stage])
+    return process_object
+
+
+def report(budget: ThreadBudget, rows: List[Dict], wall_time: float) -> str:
+    """ Describes how the time of a cohort was split between process-level and filter-level parallelism.
+        Parameters:
+            budget (ThreadBudget): budget of the run
+            rows (List[Dict]): rows with the wall time ('Time') and cpu time ('CPU') of every case
+            wall_time (float): wall time of the whole run in seconds
+        Returns: one line per level
+    """
+
+    case_time = sum(row['Time'] for row in rows)
+    cpu_time = sum(row['CPU'] for row in rows)
+    return '\n'.join([
+        repr(budget),
+        'process level: {:.1f} s of case time in {:.1f} s wall time ({:.1f} cases at a time)'.format(
+            case_time, wall_time, case_time / wall_time if wall_time else 0),
+        'filter level: {:.1f} s cpu time in {:.1f} s of case time ({:.1f} threads busy per case)'.format(
+            cpu_time, case_time, cpu_time / case_time if case_time else 0)])
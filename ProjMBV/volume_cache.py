@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Dict, Optional, Tuple
+
+import SimpleITK as sitk
+import numpy as np
+
+# the cache can be moved or switched off (MBV_VOLUME_CACHE=0) by environment variables
+CACHE_DIR = os.environ.get('MBV_VOLUME_CACHE_DIR', '.volume_cache')
+ENABLED = os.environ.get('MBV_VOLUME_CACHE', '1') != '0'
+
+# only compressed files are worth caching, all others can be read as fast as the cache
+COMPRESSED_SUFFIXES = ('.gz',)
+_TMP_PREFIX = '.tmp-'
+
+
+class VolumeCache:
+    """ Cache of decompressed input volumes.
+
+    Every compressed image (e.g. .nii.gz) is converted once into an uncompressed .npy file and a .json sidecar with
+    its geometry. Later reads memory-map the .npy file instead of decompressing the image again.
+    An entry is renewed as soon as the modification time or the size of the source file changes.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR):
+        """
+        @param directory: directory for the cached volumes (created on the first write)
+        """
+        self.directory = directory
+
+    def paths(self, path: str) -> Tuple[str, str]:
+        """ Builds the paths of the cache entry of a source file.
+
+        @param path: path of the source image
+        @return: path of the voxel file and of the sidecar
+        """
+        name = os.path.basename(path).split('.nii')[0] + '-' + \
+            hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+        base = os.path.join(self.directory, name)
+        return base + '.npy', base + '.json'
+
+    def _load_sidecar(self, path: str) -> Optional[Dict]:
+        """ Loads the sidecar of a source file, if the entry is up to date. """
+        _, sidecar_path = self.paths(path)
+        stat = os.stat(path)
+        try:
+            with open(sidecar_path) as sidecar_file:
+                sidecar = json.load(sidecar_file)
+        except (OSError, ValueError):
+            return None
+        if sidecar['mtime'] != stat.st_mtime_ns or sidecar['size'] != stat.st_size:
+            return None
+        return sidecar
+
+    def _write_atomic(self, path: str, write):
+        """ Writes a file through a temporary file, so that parallel runs never read half written files. """
+        handle, tmp_path = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                write(tmp_file)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def convert(self, path: str) -> Dict:
+        """ Decompresses a source image into the cache.
+
+        @param path: path of the source image
+        @return: the sidecar of the new entry
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        stat = os.stat(path)
+        image = sitk.ReadImage(path)
+        array = sitk.GetArrayViewFromImage(image)
+
+        voxel_path, sidecar_path = self.paths(path)
+        sidecar = {'source': os.path.abspath(path), 'mtime': stat.st_mtime_ns, 'size': stat.st_size,
+                   'spacing': image.GetSpacing(), 'origin': image.GetOrigin(), 'direction': image.GetDirection(),
+                   'vector': image.GetNumberOfComponentsPerPixel() > 1}
+        # the voxels first, the sidecar marks the entry as complete
+        self._write_atomic(voxel_path, lambda voxel_file: np.save(voxel_file, array))
+        self._write_atomic(sidecar_path, lambda sidecar_file: sidecar_file.write(json.dumps(sidecar).encode()))
+        return sidecar
+
+    def read_array(self, path: str) -> Tuple[np.ndarray, Dict]:
+        """ Gets the voxels of an image as read-only array mapped from the cache (nothing is copied).
+
+        @param path: path of the source image
+        @return: the array in numpy (z, y, x) order and the sidecar with spacing, origin and direction
+        """
+        sidecar = self._load_sidecar(path)
+        if sidecar is None:
+            sidecar = self.convert(path)
+        voxel_path, _ = self.paths(path)
+        return np.load(voxel_path, mmap_mode='r'), sidecar
+
+    def read_image(self, path: str) -> sitk.Image:
+        """ Reads an image through the cache.
+        The voxels are copied once from the mapped file into the sitk.Image (sitk can not use foreign memory),
+        which is still much faster than decompressing the source.
+
+        @param path: path of the source image
+        @return: the image with the geometry of the source
+        """
+        array, sidecar = self.read_array(path)
+        image = sitk.GetImageFromArray(array, isVector=sidecar['vector'])
+        image.SetSpacing(sidecar['spacing'])
+        image.SetOrigin(sidecar['origin'])
+        image.SetDirection(sidecar['direction'])
+        return image
+
+
+_default_cache = VolumeCache()
+
+
+def _use_cache(path: str) -> bool:
+    return ENABLED and path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def read_image(path: str) -> sitk.Image:
+    """ Reads an image like sitk.ReadImage, compressed images are read through the default cache.
+        Parameters:
+            path (str): path of the image
+        Returns: the image
+    """
+
+    if not _use_cache(path):
+        return sitk.ReadImage(path)
+    return _default_cache.read_image(path)
+
+
+def read_array(path: str) -> Tuple[np.ndarray, Dict]:
+    """ Reads the voxels of an image, compressed images are memory-mapped from the default cache.
+        Parameters:
+            path (str): path of the image
+        Returns: read-only array in numpy (z, y, x) order and a dict with spacing, origin and direction
+    """
+
+    if not _use_cache(path):
+        image = sitk.ReadImage(path)
+        return sitk.GetArrayFromImage(image), {'spacing': image.GetSpacing(), 'origin': image.GetOrigin(),
+                                               'direction': image.GetDirection()}
+    return _default_cache.read_array(path)